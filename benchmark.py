@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+# timings of the raremagic passes on synthetic plugins, no game install needed
+# the pipeline timings are written as json, to compare them between versions
+
+from array import array
+from contextlib import redirect_stdout
+from struct import pack
+import argparse
+import json
+import os.path
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import raremagic
+from raremagic import packLong, packPaddedString, packRecord, packTES3, parseNum, parseString, removeSpellSales
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start, result)
+
+def syntheticEffect(rng):
+    #effect id, skill, attribute, range, area, duration, min and max magnitude
+    return pack('<Hbbiiiii', rng.randint(0, 136), -1, -1, rng.randint(0, 2), rng.randint(0, 10), rng.randint(0, 60), rng.randint(0, 40), rng.randint(40, 100))
+
+def subRecord(t, data):
+    return t.encode('ascii') + packLong(len(data)) + data
+
+def syntheticCell(name, refs):
+    '''CELL record with a reference (FRMR, NAME and ANAM if owned) for each (object id, owner id or None)'''
+    body = subRecord('NAME', name.encode('ascii') + bytes(1)) + subRecord('DATA', bytes(12))
+    for (j, (obj, owner)) in enumerate(refs):
+        body += subRecord('FRMR', packLong(j)) + subRecord('NAME', obj.encode('ascii') + bytes(1))
+        if owner:
+            body += subRecord('ANAM', owner.encode('ascii') + bytes(1))
+        body += subRecord('DATA', bytes(24))
+    return b'CELL' + packLong(len(body)) + bytes(8) + body
+
+def syntheticPlugin(filename, prefix, books, enchantments, npcs, filler, seed=0):
+    '''writes a plugin with BOOK, ENCH, NPC_, CONT records and STAT, CELL filler, returns the number of records
+
+    A tenth of the cells have containers in them, some owned by the npcs.
+    '''
+    rng = random.Random(seed)
+    ench_ids = [ '{}_ench_{}'.format(prefix, i) for i in range(enchantments) ]
+    book_ids = [ '{}_sc_{}'.format(prefix, i) for i in range(books) ]
+    records = []
+    for ench_id in ench_ids:
+        effects = tuple( syntheticEffect(rng) for _ in range(rng.randint(1, 4)) )
+        records.append({ 'type':'ENCH', 'NAME':ench_id, 'ENDT':pack('<iiii', 0, rng.randint(1, 250), 0, 0), 'ENAM':effects })
+    for book_id in book_ids:
+        scroll = bool(ench_ids) and rng.random() < 0.7
+        book = { 'type':'BOOK', 'NAME':book_id, 'MODL':'m\\Text_Scroll_01.nif', 'FNAM':'Scroll of {}'.format(book_id),
+                 'BKDT':pack('<fiiii', 0.2, 10, int(scroll), -1, 100) }
+        if rng.random() < 0.05:
+            book['SCRI'] = 'synthetic_script'
+        book['ITEX'] = 'm\\Tx_scroll_01.tga'
+        book['TEXT'] = 'synthetic text ' * rng.randint(1, 100)
+        if scroll:
+            book['ENAM'] = rng.choice(ench_ids)
+        records.append(book)
+    for i in range(npcs):
+        npc = { 'type':'NPC_', 'NAME':'{}_npc_{}'.format(prefix, i), 'FNAM':'Synthetic', 'RNAM':'Dark Elf', 'CNAM':'Trader Service',
+                'ANAM':'', 'BNAM':'b_n_dark elf_m_head_01', 'KNAM':'b_n_dark elf_m_hair_01', 'NPDT':bytes(12), 'FLAG':packLong(0x18) }
+        items = tuple( packLong(rng.randint(1, 5)) + packPaddedString(rng.choice(book_ids) if book_ids and rng.random() < 0.3 else 'misc_synthetic', 32) for _ in range(rng.randint(0, 20)) )
+        if items:
+            npc['NPCO'] = items
+        if rng.random() < 0.8:
+            npc['AIDT'] = bytes(8) + packLong(rng.getrandbits(18))
+        records.append(npc)
+    cont_ids = [ '{}_cont_{}'.format(prefix, i) for i in range(max(1, npcs // 5)) ]
+    for cont_id in cont_ids:
+        items = tuple( packLong(rng.randint(1, 5)) + packPaddedString(rng.choice(book_ids) if book_ids and rng.random() < 0.1 else 'misc_synthetic', 32) for _ in range(rng.randint(1, 10)) )
+        records.append({ 'type':'CONT', 'NAME':cont_id, 'MODL':'synthetic.nif', 'CNDT':pack('<f', 100), 'FLAG':packLong(8), 'CNTO':items })
+    records = [ packRecord(record) for record in records ]
+    for i in range(filler):
+        records.append(packRecord({ 'type':'STAT', 'NAME':'{}_stat_{}'.format(prefix, i), 'MODL':'synthetic.nif' }))
+        refs = [ ('{}_stat_{}'.format(prefix, rng.randrange(filler)), None) for j in range(50) ]
+        if rng.random() < 0.1:
+            owner = '{}_npc_{}'.format(prefix, rng.randrange(npcs)) if npcs and rng.random() < 0.5 else None
+            refs[rng.randrange(50)] = (rng.choice(cont_ids), owner)
+        records.append(syntheticCell('{} cell {}'.format(prefix, i), refs))
+    with open(filename, 'wb') as f:
+        f.write(packTES3('benchmark', 'synthetic plugin', len(records)))
+        for record in records:
+            f.write(record)
+    return len(records)
+
+def syntheticLoadOrder(directory, plugins, books, enchantments, npcs, filler):
+    '''writes plugins and a openmw.cfg that loads them, the plugins override some records of the first'''
+    data = os.path.join(directory, 'data')
+    os.makedirs(data, exist_ok=True)
+    names = []
+    for i in range(plugins):
+        name = 'synthetic_{}.esp'.format(i)
+        #the first plugin is the 'master', the others get a tenth of the records and half override it
+        scale = 1 if i == 0 else 10
+        prefix = 'p0' if i % 2 == 0 else 'p{}'.format(i)
+        syntheticPlugin(os.path.join(data, name), prefix, books // scale, enchantments // scale, npcs // scale, filler // scale, seed=i)
+        names.append(name)
+    cfg = os.path.join(directory, 'openmw.cfg')
+    with open(cfg, 'w') as f:
+        f.write('data="{}"\n'.format(data))
+        for name in names:
+            f.write('content={}\n'.format(name))
+    return cfg
+
+def dictRecord(rec, binary_blacklist, multi_whitelist = []):
+    '''parseRecord before records were Record objects, as a reference'''
+    d  = {'type' : rec.type, 'fullpath' : 'synthetic'}
+    for r in rec.subrecords:
+        r_va = bytes(r.data) if r.type in binary_blacklist else parseString(r.data)
+        if r.type in multi_whitelist:
+            d[r.type] = d.get(r.type, tuple()) + (r_va,)
+        else:
+            d[r.type] = r_va
+    return d
+
+def parsedMemory(fp_mods, parse):
+    '''bytes allocated by the parsed BOOK, ENCH and NPC_ records of the load order'''
+    blacklist = raremagic.binary_blacklist
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    parsed = []
+    for f in fp_mods:
+        (rbookt, encht, npct) = raremagic.getRecords(f, ('BOOK', 'ENCH', 'NPC_'))
+        parsed += [ parse(x, blacklist, ['NPCO', 'NPCS']) for x in npct ]
+        parsed += [ parse(x, blacklist) for x in rbookt ]
+        parsed += [ parse(x, blacklist + ['ENAM'], ['ENAM']) for x in encht ]
+        del rbookt, encht, npct
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size
+
+def benchPipeline(directory, plugins, books, enchantments, npcs, filler, seed, memory=False):
+    '''times each pass of raremagic.main separately on a synthetic load order'''
+    phases = {}
+    (phases['generate'], cfg) = timed(syntheticLoadOrder, directory, plugins, books, enchantments, npcs, filler)
+    with redirect_stdout(sys.stderr):
+        (phases['readCfg'], fp_mods) = timed(raremagic.readCfg, cfg)
+
+    stats = raremagic.ScanStats()
+    cells = [ (f, array('Q')) for f in fp_mods ]
+    (phases['getRecords'], raw) = timed(lambda: [ raremagic.getRecords(f, ('BOOK', 'ENCH', 'NPC_', 'CONT'), stats, {'CELL': cellst}) for (f, cellst) in cells ])
+
+    def parseAll():
+        rbook, rench, rnpcs, rcont = [], [], [], []
+        blacklist = raremagic.binary_blacklist
+        for (rbookt, encht, npct, contt) in raw:
+            rnpcs += [ raremagic.parseRecord(x, blacklist, ['NPCO', 'NPCS']) for x in npct ]
+            rbook += [ raremagic.parseRecord(x, blacklist) for x in rbookt ]
+            rench += [ raremagic.parseRecord(x, blacklist + ['ENAM'], ['ENAM']) for x in encht ]
+            rcont += [ raremagic.parseRecord(x, blacklist, ['CNTO']) for x in contt ]
+        return (rbook, rench, rnpcs, rcont)
+    (phases['parseRecord'], (rbook, rench, rnpcs, rcont)) = timed(parseAll)
+
+    (phases['dedup'], (rbook, rench, rnpcs, rcont)) = timed(lambda: tuple(map(raremagic.latestRecords, (rbook, rench, rnpcs, rcont))))
+
+    def transform():
+        scripted_magic_scrolls, magic_scrolls = raremagic.splitMagicScrolls(rbook)
+        return (magic_scrolls, list(raremagic.scribeScrolls(scripted_magic_scrolls, magic_scrolls, rench, seed)))
+    (phases['scrolls'], (magic_scrolls, scribed)) = timed(transform)
+
+    magic_scroll_ids = frozenset(x['NAME'].lower() for x in magic_scrolls) | {'random_scroll_all'}
+    (phases['npcs'], npc_records) = timed(lambda: [ packRecord(npc) for npc in removeSpellSales(rnpcs, magic_scroll_ids) ])
+
+    cell_stats = raremagic.ScanStats()
+    def containers():
+        placements = raremagic.containerPlacements(cells, raremagic.scrollContainers(rcont, magic_scroll_ids), cell_stats)
+        return [ packRecord(cont) for cont in raremagic.removeContainerScrolls(rcont, placements, raremagic.scrollSellers(rnpcs), magic_scroll_ids) ]
+    (phases['containers'], cont_records) = timed(containers)
+    npc_records += cont_records
+
+    def write():
+        with raremagic.ModWriter(os.path.join(directory, 'scribe_scrolls.omwaddon'), 'benchmark', 'scribe scrolls', 3) as writer:
+            for (section, record) in scribed:
+                writer.write(record, section)
+        with raremagic.ModWriter(os.path.join(directory, 'no_spells_for_sale.omwaddon'), 'benchmark', 'no spells for sale') as writer:
+            for record in npc_records:
+                writer.write(record)
+    (phases['write'], _) = timed(write)
+
+    result = { 'phases' : phases,
+               'counts' : { 'plugins' : len(fp_mods), 'books' : len(rbook), 'enchantments' : len(rench), 'npcs' : len(rnpcs),
+                            'magic_scrolls' : len(magic_scrolls), 'scribe_records' : len(scribed), 'npc_records' : len(npc_records),
+                            'containers' : len(rcont), 'container_records' : len(cont_records),
+                            'bytes_parsed' : stats.bytes_parsed, 'bytes_skipped' : stats.bytes_skipped,
+                            'cell_bytes_parsed' : cell_stats.bytes_parsed, 'cell_bytes_searched' : cell_stats.bytes_searched } }
+    if memory:
+        del raw, rbook, rench, rnpcs, magic_scrolls, scribed, npc_records
+        result['memory'] = { 'records' : parsedMemory(fp_mods, raremagic.parseRecord),
+                             'dicts' : parsedMemory(fp_mods, dictRecord) }
+    return result
+
+def syntheticMerchants(merchants, scrolls, items, seed=0):
+    '''(npcs, scroll ids), each npc with a AIDT and a inventory of items ids'''
+    rng = random.Random(seed)
+    scroll_ids = [ 'sc_synthetic_{}'.format(i) for i in range(scrolls) ]
+    misc_ids = [ 'misc_synthetic_{}'.format(i) for i in range(scrolls) ]
+    npcs = []
+    for i in range(merchants):
+        flags = rng.getrandbits(18)
+        inventory = tuple( packLong(rng.randint(1, 5)) + packPaddedString(rng.choice(scroll_ids if rng.random() < 0.2 else misc_ids), 32) for _ in range(items) )
+        npcs.append({ 'type':'NPC_', 'NAME':'merchant_{}'.format(i), 'AIDT':bytes(8) + packLong(flags), 'NPCO':inventory })
+    return (npcs, scroll_ids)
+
+def listScan(rnpcs, magic_scroll_names):
+    '''the vendor pass before it used a set, as a reference'''
+    count = 0
+    for npc in rnpcs:
+        flags = parseNum(npc['AIDT'][8:])
+        if flags & raremagic.scrollSellerFlags:
+            count += len([ item for item in npc['NPCO'] if parseString(item[4:]) not in magic_scroll_names ])
+    return count
+
+def benchVendors(merchants, scrolls, items):
+    (npcs, scroll_ids) = syntheticMerchants(merchants, scrolls, items)
+    (list_time, _) = timed(listScan, npcs, scroll_ids + ['random_scroll_all'])
+    scroll_set = frozenset(x.lower() for x in scroll_ids) | {'random_scroll_all'}
+    (set_time, changed) = timed(removeSpellSales, npcs, scroll_set)
+    print('vendor pass, {} merchants with {} items, {} scroll ids'.format(merchants, items, scrolls))
+    print('  list scan: {:.3f}s'.format(list_time))
+    print('  set lookup: {:.3f}s ({} npcs changed)'.format(set_time, len(changed)))
+
+def concatPack(rec):
+    '''packRecord before it appended the subrecords in place, as a reference'''
+    rec = dict(rec)
+    t = rec.pop('type')
+    recbyt = b''
+    for k,c in rec.items():
+        for v in (c if isinstance(c, tuple) else (c,)):
+            if isinstance(v, str):
+                v = bytes(v, 'ascii') + bytes(1)
+            recbyt += bytes(k, 'ascii') + packLong(len(v)) + v
+    return bytes(t, 'ascii') + packLong(len(recbyt)) + bytes(8) + recbyt
+
+def benchPack(merchants, items):
+    (npcs, _) = syntheticMerchants(merchants, 100, items)
+    (concat_time, _) = timed(lambda: [ concatPack(x) for x in npcs ])
+    (join_time, _) = timed(lambda: [ packRecord(x) for x in npcs ])
+    print('packRecord, {} npcs with {} items'.format(merchants, items))
+    print('  concatenation: {:.0f} records/s'.format(merchants / concat_time))
+    print('  in place: {:.0f} records/s'.format(merchants / join_time))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--plugins', type = int, default = 20,
+                        help = 'Number of synthetic plugins in the load order. Default %(default)s.')
+
+    parser.add_argument('--books', type = int, default = 5000,
+                        help = 'BOOK records of the first plugin, the others have a tenth. Default %(default)s.')
+
+    parser.add_argument('--enchantments', type = int, default = 3000,
+                        help = 'ENCH records of the first plugin, the others have a tenth. Default %(default)s.')
+
+    parser.add_argument('--npcs', type = int, default = 5000,
+                        help = 'NPC_ records of the first plugin, the others have a tenth. Default %(default)s.')
+
+    parser.add_argument('--filler', type = int, default = 10000,
+                        help = 'STAT and CELL records of the first plugin, the others have a tenth. Default %(default)s.')
+
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = 'Seed of the scroll costs. Default %(default)s.')
+
+    parser.add_argument('--dir', type = str, default = None,
+                        help = 'Directory for the synthetic plugins and modules. By default, a temporary directory.')
+
+    parser.add_argument('-o', '--output', type = str, default = None,
+                        help = 'File to write the json results to. By default, standard output.')
+
+    parser.add_argument('--memory', default = False, action = 'store_true',
+                        help = 'Also measure the memory of the parsed records, and of the dicts they replaced.')
+
+    parser.add_argument('--micro', default = False, action = 'store_true',
+                        help = 'Also run the vendor pass and packRecord comparisons, printed to standard error.')
+
+    parser.add_argument('--merchants', type = int, default = 5000,
+                        help = 'Number of synthetic merchants of the vendor pass comparison. Default %(default)s.')
+
+    parser.add_argument('--scrolls', type = int, default = 2000,
+                        help = 'Number of synthetic magic scroll ids of the vendor pass comparison. Default %(default)s.')
+
+    parser.add_argument('--items', type = int, default = 20,
+                        help = 'Inventory entries of each merchant of the vendor pass comparison. Default %(default)s.')
+    p = parser.parse_args()
+
+    params = { k : getattr(p, k) for k in ('plugins', 'books', 'enchantments', 'npcs', 'filler', 'seed') }
+    if p.dir:
+        result = benchPipeline(p.dir, memory=p.memory, **params)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            result = benchPipeline(directory, memory=p.memory, **params)
+    result['params'] = params
+    result['python'] = platform.python_version()
+    result['numpy'] = raremagic.numpy is not None
+    result['time'] = time.time()
+
+    if p.output:
+        with open(p.output, 'w') as f:
+            json.dump(result, f, indent=1)
+    else:
+        json.dump(result, sys.stdout, indent=1)
+        print()
+
+    if p.micro:
+        with redirect_stdout(sys.stderr):
+            benchVendors(p.merchants, p.scrolls, p.items)
+            benchPack(p.merchants, p.items)
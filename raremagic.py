@@ -1,14 +1,37 @@
 #!/usr/bin/env python3
 
-from struct import pack, unpack
+from struct import pack, unpack, Struct
+import struct
 from datetime import date
 from pathlib import Path
 import os.path
+import mmap
+import hashlib
+import pickle
+import json
+import functools
+from collections import OrderedDict
+from collections.abc import Mapping
+from array import array
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 import sys
 import re
 from typing import List
 import random
+import time
+import threading
+try:
+    import numpy
+except ImportError: #the scalar school costs are used instead
+    numpy = None
+import tracemalloc
+try:
+    import resource
+except ImportError: #windows
+    resource = None
 
 configFilename = 'openmw.cfg'
 configPaths = { 'linux':   '~/.config/openmw',
@@ -19,6 +42,18 @@ modPaths = { 'linux':   '~/.local/share/openmw/data',
              'freebsd': '~/.local/share/openmw/data',
              'darwin':  '~/Library/Application Support/openmw/data' }
 
+#parsed plugins are cached in this subdirectory of the mod directory
+cacheDirName = 'raremagic_cache'
+#change when the parsed records change, to invalidate old caches
+cacheVersion = 4
+defaultCacheSize = 512 * 1024 * 1024
+#plugins at least this big get a record index in the cache, to read them again without scanning them
+indexMinSize = 16 * 1024 * 1024
+#the inputs of the last run are stored in this file of the mod directory
+manifestName = 'raremagic_manifest.json'
+#change when the created modules change, to regenerate them even if the load order didn't
+scriptVersion = 4
+
 
 def spellname_from_scroll(name, fname):
     #some 'normal' spells with only one effect with non-standard names, which might be changed by patches
@@ -49,22 +84,35 @@ class Magic:
         self.color = color
         self.name = name
         self.effect_table = effect_table
+        self.magnitude = 0
 
     def updatecost(self, duration, min_mag, max_mag):
-        if duration <= 1: #instant, probably on self, deserves bump
-            duration = 40
+        #only the most difficult effect of the school counts
+        self.magnitude = max(self.magnitude, effectMagnitude(self.dur_mult, duration, min_mag, max_mag))
+
+    def randomizecost(self, rng=random):
         #introduce randomness, even if the cost of series of spells don't make sense
-        mag = (min_mag + max_mag) / 2 + self.dur_mult*duration
-        mag = max(0, min(100, mag))
+        mag = self.magnitude
         if mag > self.cost:
             if mag <= 10:
-                mag += random.randint(0, 10)
+                mag += rng.randint(0, 10)
             elif mag >= 90:
-                mag += random.randint(-10, 0)
+                mag += rng.randint(-10, 0)
             else:
-                mag += random.randint(-4, 4)
+                mag += rng.randint(-4, 4)
             self.cost = int(mag)
 
+def effectMagnitude(dur_mult, duration, min_mag, max_mag):
+    if duration <= 1: #instant, probably on self, deserves bump
+        duration = 40
+    mag = (min_mag + max_mag) / 2 + dur_mult*duration
+    return max(0, min(100, mag))
+
+def scrollRandom(seed, scroll_id):
+    '''random generator that only depends on the seed and the (case insensitive) scroll id'''
+    digest = hashlib.sha1('{}:{}'.format(seed, scroll_id.lower()).encode('utf-8')).digest()
+    return random.Random(int.from_bytes(digest[:8], 'little'))
+
 class Schools:
     #effect number tables come from https://en.uesp.net/morrow/hints/mweffects.shtml
     def __init__(self):
@@ -75,15 +123,8 @@ class Schools:
         self.Mysticism = Magic(0, 0.2, '383C9C', 'Mysticism', [53,57,58,59,60,61,62,63,64,65,66,67,68,85,86,87,88,89])
         self.Restoration = Magic(0, 0.2 , '001BB9', 'Restoration', [69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,90,91,92,93,94,95,96,97,98,99,100,117])
 
-def createScript(script_name: str, spell_record_name: str, spell_name: str, schools: List[Magic]):
-    if_block = ''
-    endif_block = ''
-    for magic_school in schools:
-        if magic_school.cost > 0:
-            if_block += '\n        if (player->Get{} >= {})'.format(magic_school.name,magic_school.cost)
-            endif_block += '\n        endif'
-    return \
-'''begin {}
+#the text of every learning script, only the names and the skill requirements change
+scriptTemplate = '''begin {0}
 short OnPCEquip
 short PCSkipEquip
 if (MenuMode == 0)
@@ -91,11 +132,11 @@ if (MenuMode == 0)
 endif
 if (OnPCEquip == 1)
     set OnPCEquip to 0
-    if (player->GetSpell "{}" == 0){}
-            player->AddSpell "{}"
-            messagebox "You have learned the spell '{}'!"
+    if (player->GetSpell "{1}" == 0){2}
+            player->AddSpell "{1}"
+            messagebox "You have learned the spell '{3}'!"
             playsound "skillraise"
-            return{}
+            return{4}
         set PCSkipEquip to 0
         messagebox "More study is required to scribe this scroll."
     else
@@ -104,8 +145,19 @@ if (OnPCEquip == 1)
     return
 endif
 set PCSkipEquip to 1
-end {}
-'''.format(script_name, spell_record_name, if_block, spell_record_name, spell_name, endif_block, script_name)
+end {0}
+'''
+
+@functools.lru_cache(maxsize=None)
+def requirementBlocks(requirements):
+    '''(if block, endif block) of the script for a tuple of (school name, cost) requirements'''
+    if_block = ''.join( '\n        if (player->Get{} >= {})'.format(name, cost) for (name, cost) in requirements )
+    return (if_block, '\n        endif' * len(requirements))
+
+def createScript(script_name: str, spell_record_name: str, spell_name: str, schools: List[Magic]):
+    #many scrolls have the same requirements, so the blocks are only created once for each
+    (if_block, endif_block) = requirementBlocks(tuple( (magic_school.name, magic_school.cost) for magic_school in schools if magic_school.cost > 0 ))
+    return scriptTemplate.format(script_name, spell_record_name, if_block, spell_name, endif_block)
 
 def packLong(i):
     # little-endian, "standard" 4-bytes (old 32-bit systems)
@@ -120,6 +172,7 @@ def packPaddedString(s, l):
         return bs + bytes(l - len(bs))
 
 def parseString(ba):
+    ba = bytes(ba) # fields can be memoryviews into the mapped plugin
     i = ba.find(0) # find first \0
     if i == -1:
         i = len(ba)
@@ -131,82 +184,494 @@ def parseNum(ba):
 def parseFloat(ba):
     return unpack('f', ba)[0]
 
-def readHeader(ba):
-    header = {}
-    header['type'] = ba[0:4].decode()
-    header['length'] = int.from_bytes(ba[4:8], 'little')
-    return header
-
-def readSubRecord(ba):
-    sr = {}
-    sr['type'] = ba[0:4].decode()
-    sr['length'] = int.from_bytes(ba[4:8], 'little')
-    endbyte = 8 + sr['length']
-    sr['data'] = ba[8:endbyte]
-    return (sr, ba[endbyte:])
-
-def readRecords(filename):
-    fh = open(filename, 'rb')
-    while True:
-        headerba = fh.read(16)
-        if headerba is None or len(headerba) < 16:
+def readSubRecords(buf, start, end):
+    '''(types, offsets) of the subrecords of a record body in buf[start:end]
+
+    types are the 4 byte subrecord types concatenated, offsets are where the
+    data of each subrecord starts, relative to start.
+    '''
+    types = bytearray()
+    offsets = array('I')
+    i = start
+    while i + 8 <= end:
+        types += buf[i:i+4]
+        offsets.append(i + 8 - start)
+        i += 8 + int.from_bytes(buf[i+4:i+8], 'little')
+    return (bytes(types), offsets)
+
+class SubRecord:
+    __slots__ = ('type', 'data')
+
+    def __init__(self, srtype, data):
+        self.type = srtype
+        self.data = data
+
+    @property
+    def length(self):
+        return len(self.data)
+
+@functools.lru_cache(maxsize=None)
+def fieldSet(fields):
+    #records parsed with the same lists share the same sets
+    return frozenset(fields)
+
+class Record(Mapping):
+    '''a record that keeps its subrecords as they are in the plugin and decodes fields on access
+
+    body is the record without header, types the concatenated subrecord types
+    and offsets where the data of each subrecord starts in body. As with the
+    dicts this replaced, a field is a string unless its type is in binary
+    (None makes every field binary), the last value if it's repeated, or a list
+    of every value if its type is in multi. 'type' is the record type.
+    Assigned fields are kept in changes and come after the others if new.
+    '''
+    __slots__ = ('type', 'body', 'types', 'offsets', 'binary', 'multi', 'changes')
+
+    def __init__(self, rectype, body, types, offsets, binary=None, multi=frozenset()):
+        self.type = rectype
+        self.body = body
+        self.types = types
+        self.offsets = offsets
+        self.binary = binary
+        self.multi = multi
+        self.changes = None
+
+    @property
+    def length(self):
+        return len(self.body)
+
+    @property
+    def subrecords(self):
+        return [ SubRecord(self.types[4*i:4*i+4].decode(), self._data(i)) for i in range(len(self.offsets)) ]
+
+    def _data(self, i):
+        start = self.offsets[i]
+        return self.body[start:start + int.from_bytes(self.body[start-4:start], 'little')]
+
+    def _indexes(self, k):
+        '''indexes of the subrecords of type k'''
+        if len(k) != 4:
+            return []
+        kb = k.encode('ascii', 'replace')
+        indexes = []
+        i = self.types.find(kb)
+        while i != -1:
+            if i % 4 == 0:
+                indexes.append(i // 4)
+            i = self.types.find(kb, i + 1)
+        return indexes
+
+    def _last(self, k):
+        '''index of the last subrecord of type k, -1 if there is none'''
+        if len(k) != 4:
+            return -1
+        kb = k.encode('ascii', 'replace')
+        i = self.types.rfind(kb)
+        while i > 0 and i % 4 != 0: #types are 4 bytes, but a match can start inside one
+            i = self.types.rfind(kb, 0, i + 3)
+        return i // 4 if i != -1 else -1
+
+    def _decode(self, k, data):
+        if self.binary is None or k in self.binary:
+            return bytes(data)
+        return parseString(data)
+
+    def __getitem__(self, k):
+        if self.changes and k in self.changes:
+            return self.changes[k]
+        if k == 'type':
+            return self.type
+        if k in self.multi:
+            indexes = self._indexes(k)
+            if not indexes:
+                raise KeyError(k)
+            return [ self._decode(k, self._data(i)) for i in indexes ]
+        i = self._last(k)
+        if i == -1:
+            raise KeyError(k)
+        return self._decode(k, self._data(i))
+
+    def __setitem__(self, k, v):
+        if k == 'type':
+            self.type = v
+            return
+        if self.changes is None:
+            self.changes = {}
+        self.changes[k] = v
+
+    def __contains__(self, k):
+        return k == 'type' or bool(self.changes and k in self.changes) or self._last(k) != -1
+
+    def __iter__(self):
+        yield 'type'
+        seen = set()
+        for i in range(0, len(self.types), 4):
+            k = self.types[i:i+4].decode('ascii', 'replace')
+            if k not in seen:
+                seen.add(k)
+                yield k
+        for k in self.changes or ():
+            if k not in seen:
+                yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        '''a record with the same plugin data and its own changes'''
+        r = Record(self.type, self.body, self.types, self.offsets, self.binary, self.multi)
+        r.changes = dict(self.changes) if self.changes else None
+        return r
+
+    def __repr__(self):
+        return 'Record({!r}, {})'.format(self.type, ', '.join(k for k in self if k != 'type'))
+
+def mapFile(filename):
+    '''read only memoryview of the whole file, empty if the file is empty
+
+    filename can also be the contents of the file, already read.
+    '''
+    if isinstance(filename, (bytes, bytearray, memoryview)):
+        return memoryview(filename)
+    with open(filename, 'rb') as fh:
+        try:
+            #the map stays valid after the file is closed, and lives as long as any view
+            return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError: #can't map a empty file
+            return memoryview(b'')
+
+class ScanStats:
+    '''bytes and records that were split into subrecords (parsed), only searched (searched) or seeked over (skipped)'''
+    def __init__(self):
+        self.bytes_parsed = 0
+        self.bytes_searched = 0
+        self.bytes_skipped = 0
+        self.records_parsed = 0
+        self.records_searched = 0
+        self.records_skipped = 0
+        self.seconds = 0.0
+
+    def add(self, other):
+        self.bytes_parsed += other.bytes_parsed
+        self.bytes_searched += other.bytes_searched
+        self.bytes_skipped += other.bytes_skipped
+        self.records_parsed += other.records_parsed
+        self.records_searched += other.records_searched
+        self.records_skipped += other.records_skipped
+        self.seconds += other.seconds
+
+    def __str__(self):
+        searched = ', {} records ({} bytes) searched'.format(self.records_searched, self.bytes_searched) if self.records_searched else ''
+        return '{} records ({} bytes) parsed{}, {} records ({} bytes) skipped'.format(
+            self.records_parsed, self.bytes_parsed, searched, self.records_skipped, self.bytes_skipped)
+
+def readRecords(filename, rectypes=None, stats=None, spans=None, index=None):
+    '''yields the records of the plugin, only the ones with a type in rectypes if given
+
+    Unwanted records are skipped by their header length, without touching their body.
+    spans maps record types to arrays where the (start, end) offsets of the bodies
+    of their records are appended instead, to read them later if needed (like CELL).
+    With a index of the plugin, the wanted records are seeked to without reading the others.
+    '''
+    if index is not None and rectypes is not None:
+        yield from readIndexedRecords(filename, rectypes, stats, spans, index)
+        return
+    if rectypes is not None:
+        rectypes = frozenset(bytes(t, 'ascii') for t in rectypes)
+    spans = { bytes(t, 'ascii') : a for t, a in (spans or {}).items() }
+    if stats is None:
+        stats = ScanStats()
+    buf = mapFile(filename)
+    offset = 0
+    size = len(buf)
+    while offset + 16 <= size:
+        rectype = bytes(buf[offset:offset+4])
+        length = int.from_bytes(buf[offset+4:offset+8], 'little')
+        start = offset + 16
+        offset = min(start + length, size)
+        if rectypes is not None and rectype not in rectypes or rectype in spans:
+            if rectype in spans:
+                spans[rectype].extend((start, offset))
+            stats.records_skipped += 1
+            stats.bytes_skipped += offset - start + 16
+            continue
+        stats.records_parsed += 1
+        stats.bytes_parsed += offset - start + 16
+
+        (types, offsets) = readSubRecords(buf, start, offset)
+        yield Record(rectype.decode(), buf[start:offset], types, offsets)
+
+def readIndexedRecords(filename, rectypes, stats, spans, index):
+    '''readRecords with a index of the plugin'''
+    if stats is None:
+        stats = ScanStats()
+    buf = mapFile(filename)
+    for t, a in (spans or {}).items():
+        for i in index.positions((t,)):
+            a.extend((index.offsets[i] + 16, index.offsets[i] + 16 + index.lengths[i]))
+    positions = index.positions([ t for t in rectypes if t not in (spans or {}) ])
+    #everything else is seeked over
+    stats.records_skipped += len(index) - len(positions)
+    stats.bytes_skipped += sum(index.lengths) + 16 * len(index) - sum(index.lengths[i] + 16 for i in positions)
+    for i in positions:
+        stats.records_parsed += 1
+        stats.bytes_parsed += index.lengths[i] + 16
+        yield readRecord(buf, index, i)
+
+def getRecords(filename, rectypes, stats=None, spans=None, index=None):
+    '''list of records for each of the rectypes, in the same order'''
+    buckets = { t : [] for t in rectypes }
+    for r in readRecords(filename, rectypes, stats, spans, index):
+        buckets[r.type].append(r)
+    return [ buckets[t] for t in rectypes ]
+
+#sidecar indexes start with this header: magic, version, plugin size and mtime, sha1 of the plugin header record and number of records
+indexHeader = Struct('<4sIQQ20sI')
+indexMagic = b'RMIX'
+indexVersion = 1
+
+def headerHash(buf):
+    '''sha1 of the first record of a plugin, the TES3 header with the masters'''
+    end = min(16 + int.from_bytes(buf[4:8], 'little'), len(buf)) if len(buf) >= 16 else len(buf)
+    return hashlib.sha1(buf[:end]).digest()
+
+def littleEndian(a):
+    '''a copy of the array a in little endian order, or a itself if that is the native order'''
+    if sys.byteorder == 'big':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a
+
+class RecordIndex:
+    '''type, offset, length, flags and id (NAME) of every record of a plugin, to read records without scanning it
+
+    types are the 4 byte record types concatenated, offsets where each record header
+    starts, lengths the length of each record body and flags the record flags. The
+    ids are concatenated in ids, the id of record i is ids[id_offsets[i]:id_offsets[i+1]].
+    Saved as a indexHeader followed by each of these in order, little endian.
+    '''
+    def __init__(self, size, mtime, header_hash, types, offsets, lengths, flags, id_offsets, ids):
+        self.size = size
+        self.mtime = mtime
+        self.header_hash = header_hash
+        self.types = types
+        self.offsets = offsets
+        self.lengths = lengths
+        self.flags = flags
+        self.id_offsets = id_offsets
+        self.ids = ids
+        self._ids = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def build(cls, filename):
+        '''index of the plugin, from a scan of its record headers and of the NAME of each record'''
+        st = os.stat(filename)
+        buf = mapFile(filename)
+        types = bytearray()
+        offsets, lengths, flags, id_offsets = array('Q'), array('I'), array('I'), array('I', [0])
+        ids = bytearray()
+        offset = 0
+        size = len(buf)
+        while offset + 16 <= size:
+            start = offset + 16
+            end = min(start + int.from_bytes(buf[offset+4:offset+8], 'little'), size)
+            types += buf[offset:offset+4]
+            offsets.append(offset)
+            lengths.append(end - start)
+            flags.append(int.from_bytes(buf[offset+12:offset+16], 'little'))
+            #the id is the first subrecord of the records that have one
+            if end - start >= 8 and buf[start:start+4] == b'NAME':
+                data = bytes(buf[start+8:min(start + 8 + int.from_bytes(buf[start+4:start+8], 'little'), end)])
+                ids += data.split(b'\0', 1)[0]
+            id_offsets.append(len(ids))
+            offset = end
+        return cls(st.st_size, st.st_mtime_ns, headerHash(buf), bytes(types), offsets, lengths, flags, id_offsets, bytes(ids))
+
+    def save(self, filename):
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(indexHeader.pack(indexMagic, indexVersion, self.size, self.mtime, self.header_hash, len(self)))
+            f.write(self.types)
+            for a in (self.offsets, self.lengths, self.flags, self.id_offsets):
+                f.write(littleEndian(a).tobytes())
+            f.write(self.ids)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''the saved index, None if it can't be read or is from another version'''
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            (magic, version, size, mtime, header_hash, n) = indexHeader.unpack_from(data)
+            if magic != indexMagic or version != indexVersion:
+                return None
+            i = indexHeader.size
+            types = data[i:i+4*n]
+            i += 4*n
+            columns = []
+            for (typecode, count) in (('Q', n), ('I', n), ('I', n), ('I', n + 1)):
+                a = array(typecode)
+                a.frombytes(data[i:i + count * a.itemsize])
+                i += count * a.itemsize
+                columns.append(littleEndian(a))
+            return cls(size, mtime, header_hash, types, *columns, ids=data[i:])
+        except (OSError, ValueError, TypeError, struct.error):
             return None
 
-        record = {}
-        header = readHeader(headerba)
-        record['type'] = header['type']
-        record['length'] = header['length']
-        record['subrecords'] = []
-        # stash the filename here (a bit hacky, but useful)
-        record['fullpath'] = filename
-
-        remains = fh.read(header['length'])
-
-        while len(remains) > 0:
-            (subrecord, restofbytes) = readSubRecord(remains)
-            record['subrecords'].append(subrecord)
-            remains = restofbytes
-
-        yield record
-
-def getRecords(filename, rectypes):
-    numtypes = len(rectypes)
-    retval = [ [] for x in range(numtypes) ]
-    for r in readRecords(filename):
-        if r['type'] in rectypes:
-            for i in range(numtypes):
-                if r['type'] == rectypes[i]:
-                    retval[i].append(r)
-    return retval
+    def matches(self, filename):
+        '''if the plugin still has the size, mtime and header it had when indexed'''
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime and headerHash(mapFile(filename)) == self.header_hash
+
+    def verify(self, filename):
+        '''if the index is the same as a new index of the plugin, which detects changes that kept the size and mtime'''
+        new = RecordIndex.build(filename)
+        return all(getattr(self, k) == getattr(new, k) for k in ('size', 'header_hash', 'types', 'offsets', 'lengths', 'flags', 'id_offsets', 'ids'))
+
+    def positions(self, rectypes):
+        '''indexes of the records with a type in rectypes, in file order'''
+        found = []
+        for t in rectypes:
+            kb = t.encode('ascii')
+            i = self.types.find(kb)
+            while i != -1:
+                if i % 4 == 0:
+                    found.append(i // 4)
+                i = self.types.find(kb, i + 1)
+        return sorted(found)
+
+    def id(self, i):
+        return self.ids[self.id_offsets[i]:self.id_offsets[i+1]].decode(encoding='ascii', errors='ignore')
+
+    def find(self, rectype, record_id):
+        '''index of the record with this type and (case insensitive) id, the last if repeated, None if there is none'''
+        if self._ids is None:
+            self._ids = { (self.types[4*i:4*i+4], self.id(i).lower()) : i for i in range(len(self)) if self.id_offsets[i] != self.id_offsets[i+1] }
+        return self._ids.get((rectype.encode('ascii'), record_id.lower()))
+
+def readRecord(buf, index, i):
+    '''record i of the plugin in buf, seeked to with its index'''
+    start = index.offsets[i] + 16
+    end = start + index.lengths[i]
+    (types, offsets) = readSubRecords(buf, start, end)
+    return Record(index.types[4*i:4*i+4].decode(), buf[start:end], types, offsets)
+
+def lookupRecord(filename, index, rectype, record_id):
+    '''the record with this type and id of the plugin, without scanning it, None if there is none'''
+    i = index.find(rectype, record_id)
+    return None if i is None else readRecord(mapFile(filename), index, i)
+
+def cfgValue(value):
+    '''value of a openmw.cfg setting, without surrounding quotes and with & escapes of quoted paths undone'''
+    value = value.strip()
+    if not value.startswith('"'):
+        return value.strip('\'"')
+    # openmw quotes paths as "like this", with & escaping a & or a " inside
+    chars = []
+    escaped = False
+    for c in value[1:]:
+        if escaped:
+            chars.append(c)
+            escaped = False
+        elif c == '&':
+            escaped = True
+        elif c == '"':
+            break
+        else:
+            chars.append(c)
+    return ''.join(chars)
+
+def cfgPath(base, value):
+    '''path of a openmw.cfg setting, relative to the config directory base, with ?userdata? like tokens expanded'''
+    pl = sys.platform
+    tokens = { '?local?' : base, '?userconfig?' : configPaths.get(pl, base), '?userdata?' : os.path.dirname(modPaths.get(pl, base)) }
+    for token, path in tokens.items():
+        if value.startswith(token):
+            value = os.path.join(path, value[len(token):])
+    return os.path.normpath(os.path.join(base, os.path.expanduser(value)))
+
+def cfgSettings(cfg):
+    '''(data dirs, content files, config files) of a openmw.cfg and of the configs it chains with config=
+
+    Like openmw, the configs are read in order, each one after the ones that listed it,
+    and replace=data or replace=content (or any other key) forget the values read so far.
+    Relative paths are relative to the directory of the config where they appear.
+    '''
+    settings = { 'data' : [], 'data-local' : [], 'content' : [] }
+    configs = [ os.path.abspath(os.path.expanduser(cfg)) ]
+    seen = set()
+    for cfg in configs:
+        if cfg in seen:
+            continue
+        seen.add(cfg)
+        base = os.path.dirname(cfg)
+        try:
+            with open(cfg, 'r', encoding='utf-8', errors='replace') as f:
+                lines = f.readlines()
+        except OSError as e:
+            print("Couldn't read the config file '{}': {}".format(cfg, e))
+            continue
+        for l in lines:
+            l = l.strip()
+            if not l or l.startswith('#'):
+                continue
+            (varname, sep, varvalue) = l.partition('=')
+            if not sep:
+                continue
+            varname = varname.strip()
+            varvalue = cfgValue(varvalue)
+            if varname == 'replace':
+                settings[varvalue] = []
+            elif varname in ('data', 'data-local'):
+                settings[varname].append(cfgPath(base, varvalue))
+            elif varname == 'content':
+                settings['content'].append(varvalue)
+            elif varname == 'config':
+                # a directory with another openmw.cfg, read after this one
+                configs.append(os.path.join(cfgPath(base, varvalue), configFilename))
+    # data-local is always the last data dir, no matter where it's set
+    return (settings['data'] + settings['data-local'][-1:], settings['content'], list(OrderedDict.fromkeys(configs)))
+
+def dataIndex(data_dirs):
+    '''lowercase filename to full path of the files in the data dirs, the last dir wins like in openmw'''
+    index = {}
+    for p in data_dirs:
+        try:
+            #not a context manager before python 3.6, the iterator is closed when exhausted
+            for entry in os.scandir(p):
+                if entry.is_file():
+                    index[entry.name.lower()] = entry.path
+        except OSError:
+            print("Data directory '{}' not found, ignoring it".format(p))
+    return index
 
 def readCfg(cfg):
-    # first, open the file and pull all 'data' and 'content' lines, in order
-
-    data_dirs = []
-    mods = []
-    with open(cfg, 'r') as f:
-        for l in f.readlines():
-            # match of form "blah=blahblah"
-            m = re.search(r'^(.*)=(.*)$', l)
-            if m:
-                varname = m.group(1).strip()
-                # get rid of not only whitespace, but also surrounding quotes
-                varvalue = m.group(2).strip().strip('\'"')
-                if varname == 'data':
-                    data_dirs.append(varvalue)
-                elif varname == 'content':
-                    mods.append(varvalue)
-
-    # we've got the basenames of the mods, but not the full paths
-    # and we have to search through the data_dirs to find them
+    '''full paths of the content files of the cfg, in load order
+
+    Each data dir is listed once and content files are found case insensitively,
+    the content files that aren't in any data dir are reported and left out.
+    '''
+    (data_dirs, mods, _) = cfgSettings(cfg)
+    index = dataIndex(data_dirs)
+
     fp_mods = []
+    missing = []
     for m in mods:
-        for p in data_dirs:
-            full_path = os.path.join(p, m)
-            if os.path.exists(full_path):
-                fp_mods.append(full_path)
-                break
+        full_path = index.get(m.lower())
+        if full_path:
+            fp_mods.append(full_path)
+        else:
+            missing.append(m)
 
+    if missing:
+        print("Content files not found in any data directory, they are ignored: {}".format(', '.join(missing)))
     print("Config file parsed...")
 
     return fp_mods
@@ -245,197 +710,1065 @@ def packScript(name, text):
     d = { 'type':'SCPT', 'SCHD':extended, 'SCDT':bytes(0), 'SCTX':bytes(text, 'ascii') }
     return packRecord(d)
 
-# 'generic' pack record method.
-def packRecord(rec):
-    def serialize(t,k,v):
-        l = len(v)
-        if isinstance(v, str):
-            #strangely TEXT in books doesn't have a terminating \0 (didn't check potions)
-            #do this to be easier to verify in vbindiff, even if it's unlikely to cause errors
-            if k == 'TEXT' and t == 'BOOK':
-                return bytes(k, 'ascii') + packLong(l) + bytes(v,'ascii')
-            return bytes(k, 'ascii') + packLong(l+1) + bytes(v,'ascii') + bytes(1)
+#offset of the number of records in the header written by packTES3 (record header, HEDR header, version, filetype, author, description)
+numRecordsOffset = 16 + 8 + 4 + 4 + 32 + 256
+
+class ModWriter:
+    '''writes a omwaddon record by record, without keeping the records in memory
+
+    The TES3 header is written with a placeholder record count that is
+    patched when the writer is closed. Records go to a temporary file that
+    replaces the mod only after everything was written. Records of sections
+    after the first are spooled to temporary files and appended in order.
+    '''
+    def __init__(self, filename, author, desc, sections=1):
+        self.filename = filename
+        self.tmpname = filename + '.tmp'
+        self.f = open(self.tmpname, 'wb')
+        self.f.write(packTES3(author, desc, 0))
+        self.spools = [ tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename))) for _ in range(sections - 1) ]
+        self.count = 0
+
+    def write(self, record, section=0):
+        (self.spools[section - 1] if section else self.f).write(record)
+        self.count += 1
+
+    def close(self):
+        for spool in self.spools:
+            spool.seek(0)
+            shutil.copyfileobj(spool, self.f)
+            spool.close()
+        self.f.seek(numRecordsOffset)
+        self.f.write(packLong(self.count))
+        self.f.close()
+        os.replace(self.tmpname, self.filename)
+
+    def abort(self):
+        for spool in self.spools:
+            spool.close()
+        self.f.close()
+        os.remove(self.tmpname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
         else:
-            return bytes(k, 'ascii') + packLong(l) + v #is bytes if not str
+            self.abort()
 
-    reclen = 0
-    recbyt = b''
-    t  = rec.pop('type')
-    for k,c in rec.items():
-        if isinstance(c, tuple):
+# 'generic' pack record method. doesn't modify rec
+def packRecord(rec):
+    t = rec['type']
+    #strangely TEXT in books doesn't have a terminating \0 (didn't check potions)
+    #do this to be easier to verify in vbindiff, even if it's unlikely to cause errors
+    zero_text = t != 'BOOK'
+    #the header is filled when the size is known, the subrecords are appended in place
+    #(inlined packLong, this is called for every written record)
+    body = bytearray(16)
+    for k, c in rec.items():
+        if k == 'type':
+            continue
+        kb = k.encode('ascii')
+        if isinstance(c, (tuple, list)):
             for v in c:
-                b = serialize(t, k, v)
-                reclen += len(b)
-                recbyt += b
+                if isinstance(v, str):
+                    v = v.encode('ascii') + b'\0' if zero_text or k != 'TEXT' else v.encode('ascii')
+                body += kb + len(v).to_bytes(4, 'little') + v
+        elif isinstance(c, str):
+            c = c.encode('ascii') + b'\0' if zero_text or k != 'TEXT' else c.encode('ascii')
+            body += kb + len(c).to_bytes(4, 'little') + c
         else:
-            b = serialize(t, k, c)
-            reclen += len(b)
-            recbyt += b
-    return bytes(t, 'ascii') + packLong(reclen) + bytes(8) + recbyt
-#'generic' parse record method. stores (string, value) or (string, (values...))
+            body += kb + len(c).to_bytes(4, 'little') + c #is bytes if not str
+    body[0:8] = t.encode('ascii') + (len(body) - 16).to_bytes(4, 'little')
+    return bytes(body)
+#'generic' parse record method. stores (string, value) or (string, [values...])
 
-# uses a whitelist to recognize which fields should be part of a tuple
+# uses a whitelist to recognize which fields should be part of a list
 # uses a blacklist to recognize subrecords that should not be turned into strings
 # remember to analise the record on https://en.uesp.net/morrow/tech/mw_esm.txt
 # to figure out if what subrecords to add to the blacklist and whitelist
 def parseRecord(rec, binary_blacklist, multi_whitelist = []):
-    d  = {'type' : rec['type'] } #always string
-    sr = rec['subrecords']
-
-    for r in sr:
-        r_id = r['type']
-        r_va = r['data']
-        if r_id not in binary_blacklist:
-            r_va = parseString(r_va)
-        if r_id in multi_whitelist:
-            d[r_id] = d.get(r_id, tuple()) + (r_va,)
-        else:
-            d[r_id] = r_va
-    return d
-
-def main(cfg, outmoddir):
-    fp_mods = readCfg(cfg)
-
-    mod1Name = 'scribe_scrolls.omwaddon'
-    mod2Name = 'no_spells_for_sale.omwaddon'
-    mod1 = os.path.join(baseModDir, mod1Name)
-    mod2 = os.path.join(baseModDir, mod2Name)
-
-    #these subrecords can't be stored as strings
-    binary_blacklist = ['BKDT', 'DELE', 'ENDT', 'NPDT', 'FLAG', 'NPCO', 'NPCS', 'AIDT', 'AI_W', 'AI_T', 'AI_F', 'AI_E', 'AI_A', 'DODT', 'XSCL']
-
-    # unlike a levelled list merge, we only want the 'latest' version of records.
-    rbook, rench, rnpcs = [], [], []
-    for f in fp_mods:
-        base = os.path.basename(f)
-        #filter out 'our own' files.
-        if base == mod1Name or base == mod2Name:
-            continue
+    #the body is copied out of the mapped plugin, fields are only decoded when used
+    return Record(rec.type, bytes(rec.body), rec.types, rec.offsets,
+                  fieldSet(tuple(binary_blacklist)), fieldSet(tuple(multi_whitelist)))
 
-        (rbookt, encht, npct) = getRecords(f, ('BOOK', 'ENCH', 'NPC_'))
-        rnpcs += [ parseRecord(x, binary_blacklist, ['NPCO', 'NPCS']    ) for x in npct   ]
-        rbook += [ parseRecord(x, binary_blacklist                      ) for x in rbookt ]
-        #ENAM is a duplicated ID (also in books) and only binary this time
-        rench += [ parseRecord(x, binary_blacklist + ['ENAM'], ['ENAM'] ) for x in encht  ]
-    
-    #dedup, last have priority and 'win', name is the id for books, enchantments and npcs 
-    from collections import OrderedDict
-    rbook = OrderedDict( (rec['NAME'], rec) for rec in rbook ).values()
-    rench = OrderedDict( (rec['NAME'], rec) for rec in rench ).values()
-    rnpcs = OrderedDict( (rec['NAME'], rec) for rec in rnpcs ).values()
-
-    def is_magic_scroll(x):
-        return 'DELE' not in x and 'ENAM' in x and int(x['BKDT'][8]) == 1
-    def has_script(x):
-        return 'SCRI' in x
-    def magic_scroll_cost(enchantment):
-        #some scrolls have screwed up 'costs' like 'supreme domination', 'windform'
-        #The max spell cost in morrowind is about 180 and in Tamriel Rebuilt 200, so let's limit it
-        cost = parseNum(enchantment['ENDT'][4:8])
-        return cost if cost <= 190 else 200 - random.randint(0,20)
+class _NoPhase:
+    def __enter__(self):
+        pass
 
-    #we don't want to modify magic scrolls already with a script... 
-    #except for their text to indicate it can't be learned in-game because of 'strange magic'
-    scripts, scrolls, spells = [], [], []
-    scripted_magic_scrolls, magic_scrolls = partition(filter(is_magic_scroll, rbook), has_script)
-    magic_scrolls = list(magic_scrolls)    
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
 
-    for x in scripted_magic_scrolls:
-        x['TEXT'] += '<FONT><DIV ALIGN="LEFT"><BR><BR>This scroll strange magic is impossible to learn<BR><BR></FONT>'
-        scrolls += [packRecord(x)]
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
 
-    for x in magic_scrolls:
-        enchantment = next( e for e in rench if x['ENAM'] == e['NAME'] and 'DELE' not in e )
+    def __enter__(self):
+        if hasattr(tracemalloc, 'reset_peak'): #python 3.9
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, time.perf_counter() - self.start, tracemalloc.get_traced_memory()[1], maxRSS())
+
+def maxRSS():
+    '''peak resident memory of the process in bytes, None if unknown'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class Profiler:
+    '''wall time and peak memory of the phases of main, and the scan of each plugin
+
+    A phase can be entered many times, the times are added and the peak is the
+    highest of all. Disabled profilers do nothing, so the phases can always be used.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = OrderedDict()
+        self.plugins = []
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else _NoPhase()
+
+    def add(self, name, seconds, peak, rss):
+        (old_seconds, old_peak, old_rss) = self.phases.get(name, (0.0, 0, None))
+        self.phases[name] = (old_seconds + seconds, max(old_peak, peak), rss)
+
+    def plugin(self, filename, stats, cached):
+        if self.enabled:
+            self.plugins.append((filename, stats, cached))
+
+    def report(self):
+        if not self.enabled:
+            return
+        mib = 1024 * 1024
+        print("\nPhase            seconds  python peak MiB  max rss MiB")
+        for name, (seconds, peak, rss) in self.phases.items():
+            print("{:<16} {:>7.3f} {:>16.1f} {:>12}".format(name, seconds, peak / mib, '?' if rss is None else '{:.1f}'.format(rss / mib)))
+        print("\nPlugin scans, slowest first")
+        print("seconds  records parsed  MiB parsed  MiB skipped  plugin")
+        for filename, stats, cached in sorted(self.plugins, key=lambda p: -p[1].seconds):
+            print("{:>7.3f} {:>15} {:>11.1f} {:>12.1f}  {}{}".format(stats.seconds, stats.records_parsed, stats.bytes_parsed / mib,
+                  stats.bytes_skipped / mib, filename, ' (cached)' if cached else ''))
+        print()
+
+#used when the caller doesn't profile
+noProfiler = Profiler()
+
+#these subrecords can't be stored as strings
+binary_blacklist = ['BKDT', 'DELE', 'ENDT', 'NPDT', 'FLAG', 'NPCO', 'NPCS', 'AIDT', 'AI_W', 'AI_T', 'AI_F', 'AI_E', 'AI_A', 'DODT', 'XSCL', 'CNTO', 'CNDT']
+
+def parsePlugin(filename, stats=None, index=None):
+    '''parsed (books, enchantments, npcs, containers, cells) of a single plugin
+
+    cells are the (start, end) offsets of the CELL record bodies, flattened. Cells
+    are big and most have nothing to do with scrolls, so they're only read later,
+    by containerPlacements, if they mention a container that has scrolls.
+    '''
+    cells = array('Q')
+    (rbookt, encht, npct, contt) = getRecords(filename, ('BOOK', 'ENCH', 'NPC_', 'CONT'), stats, {'CELL': cells}, index)
+    rnpcs = [ parseRecord(x, binary_blacklist, ['NPCO', 'NPCS']    ) for x in npct   ]
+    rbook = [ parseRecord(x, binary_blacklist                      ) for x in rbookt ]
+    #ENAM is a duplicated ID (also in books) and only binary this time
+    rench = [ parseRecord(x, binary_blacklist + ['ENAM'], ['ENAM'] ) for x in encht  ]
+    rcont = [ parseRecord(x, binary_blacklist, ['CNTO']            ) for x in contt  ]
+    return (rbook, rench, rnpcs, rcont, cells)
+
+def fileHash(filename):
+    return hashlib.sha1(mapFile(filename)).hexdigest()
+
+class PluginCache:
+    '''on disk cache of parsePlugin results, one file per plugin
+
+    Entries are keyed by the absolute path of the plugin and are valid while
+    the size and mtime match. If only the mtime changed, the content hash
+    decides, so a touched but unchanged plugin isn't parsed again.
+    The least recently used entries are removed when the cache is above max_bytes.
+    Big plugins also get a RecordIndex entry, used to read them again if their records aren't cached.
+    The containers found in the cells of a plugin are kept too, keyed by its content hash and the containers searched.
+    '''
+    def __init__(self, cachedir, max_bytes=defaultCacheSize):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+
+    def _entry(self, filename, suffix='.pickle'):
+        key = hashlib.sha1(os.path.abspath(filename).encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.cachedir, key + suffix)
+
+    def get(self, filename, digest=None):
+        '''the cached records of the plugin, digest is its content hash if it's already known'''
+        entry = self._entry(filename)
+        try:
+            st = os.stat(filename)
+            with open(entry, 'rb') as f:
+                meta = pickle.load(f)
+                if meta['version'] != cacheVersion or meta['path'] != os.path.abspath(filename) or meta['size'] != st.st_size:
+                    return None
+                touched = meta['mtime'] != st.st_mtime_ns
+                if touched and meta['hash'] != (digest or fileHash(filename)):
+                    return None
+                records = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+            return None
+        if touched: #same contents, store the new mtime to avoid hashing next time
+            self.put(filename, records, meta['hash'])
+        else:
+            os.utime(entry) #mark as recently used
+        try:
+            #the index is the fallback if the records are evicted, so it can't be older than them
+            os.utime(self._entry(filename, '.index'))
+        except OSError: #small plugins have no index
+            pass
+        return records
+
+    def put(self, filename, records, digest=None):
+        os.makedirs(self.cachedir, exist_ok=True)
+        st = os.stat(filename)
+        meta = { 'version' : cacheVersion, 'path' : os.path.abspath(filename), 'size' : st.st_size,
+                 'mtime' : st.st_mtime_ns, 'hash' : digest or fileHash(filename) }
+        entry = self._entry(filename)
+        tmp = '{}.{}.tmp'.format(entry, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def index(self, filename):
+        '''the saved record index of the plugin, None if there is none or it's stale'''
+        entry = self._entry(filename, '.index')
+        index = RecordIndex.load(entry)
+        if index is None or not index.matches(filename):
+            return None
+        os.utime(entry) #mark as recently used
+        return index
+
+    def putIndex(self, filename, index):
+        os.makedirs(self.cachedir, exist_ok=True)
+        index.save(self._entry(filename, '.index'))
+        self.evict()
+
+    def verifyIndex(self, filename):
+        '''False if the saved record index of the plugin is stale, even if the plugin seems unchanged, and rebuilds it
+
+        The cached records of a plugin with a stale index are stale too, they are removed.
+        '''
+        entry = self._entry(filename, '.index')
+        index = RecordIndex.load(entry)
+        if index is None and not os.path.exists(entry):
+            return True
+        if index is not None and index.matches(filename) and index.verify(filename):
+            return True
+        self.remove(filename)
+        self.putIndex(filename, RecordIndex.build(filename))
+        return False
+
+    def remove(self, filename):
+        '''removes the cached records of the plugin'''
+        try:
+            os.remove(self._entry(filename))
+        except OSError: #not cached
+            pass
+
+    def placements(self, filename, digest, containers_key):
+        '''the cached containerPlacements of the plugin with the digest content hash, for the containers of containers_key'''
+        entry = self._entry(filename, '.{}.cells'.format(containers_key))
+        try:
+            with open(entry, 'rb') as f:
+                meta = pickle.load(f)
+                if meta['version'] != cacheVersion or meta['path'] != os.path.abspath(filename) or meta['hash'] != digest:
+                    return None
+                placements = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+            return None
+        os.utime(entry) #mark as recently used
+        return placements
+
+    def putPlacements(self, filename, digest, containers_key, placements):
+        os.makedirs(self.cachedir, exist_ok=True)
+        meta = { 'version' : cacheVersion, 'path' : os.path.abspath(filename), 'hash' : digest }
+        entry = self._entry(filename, '.{}.cells'.format(containers_key))
+        tmp = '{}.{}.tmp'.format(entry, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(placements, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def fresh(self, filename):
+        '''if the cache has the plugin with its current size and mtime, without loading it'''
+        try:
+            st = os.stat(filename)
+            with open(self._entry(filename), 'rb') as f:
+                meta = pickle.load(f)
+            return meta['version'] == cacheVersion and meta['path'] == os.path.abspath(filename) and \
+                   meta['size'] == st.st_size and meta['mtime'] == st.st_mtime_ns
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+            return False
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.cachedir)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if name.endswith(('.pickle', '.index', '.cells')):
+                path = os.path.join(self.cachedir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        return entries
+
+    def evict(self):
+        #a index used as recently as its records outlives them, it's the fallback to read the plugin again
+        entries = sorted(self._entries(), key=lambda e: (e[0], e[2].endswith('.index')))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError: #already removed by another process
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            os.remove(path)
+
+def latestRecords(records):
+    '''dedup, last have priority and 'win', name is the id for books, enchantments and npcs'''
+    return OrderedDict( (rec['NAME'], rec) for rec in records ).values()
+
+#sections of the scribe scrolls module, in the order they are written
+SCRIPTS, SPELLS, SCROLLS = 0, 1, 2
+
+strangeMagicText = '<FONT><DIV ALIGN="LEFT"><BR><BR>This scroll strange magic is impossible to learn<BR><BR></FONT>'
+
+def isMagicScroll(x):
+    return 'DELE' not in x and 'ENAM' in x and int(x['BKDT'][8]) == 1
+
+def hasScript(x):
+    return 'SCRI' in x
+
+def magicScrollCost(enchantment, rng):
+    #some scrolls have screwed up 'costs' like 'supreme domination', 'windform'
+    #The max spell cost in morrowind is about 180 and in Tamriel Rebuilt 200, so let's limit it
+    cost = parseNum(enchantment['ENDT'][4:8])
+    return cost if cost <= 190 else 200 - rng.randint(0,20)
+
+def splitMagicScrolls(rbook):
+    '''(scripted magic scrolls, magic scrolls without script) of the books'''
+    scripted_magic_scrolls, magic_scrolls = partition(filter(isMagicScroll, rbook), hasScript)
+    magic_scrolls = list(magic_scrolls)
+    return (list(scripted_magic_scrolls), magic_scrolls)
+
+#layout of a ENAM effect: id, skill, attribute, range, area, duration, min and max magnitude
+effectFields = [ ('id', '<u2'), ('skill', 'i1'), ('attribute', 'i1'), ('range', '<u4'), ('area', '<u4'),
+                 ('duration', '<u4'), ('min', '<u4'), ('max', '<u4') ]
+
+def schoolMagnitudes(enchantments):
+    '''{lowercase enchantment id: [magnitude of each school]} of all the enchantments at once, with numpy
+
+    Gives the same magnitudes as Magic.updatecost. Enchantments with effects of
+    a unexpected size are left out, for the scalar path.
+    '''
+    schools = [e for e in Schools().__dict__.values()]
+    #the scalar path uses the first school with the effect, so those are assigned last
+    school_of_effect = numpy.full(1 << 16, -1, numpy.int8)
+    for i, magic_school in reversed(list(enumerate(schools))):
+        school_of_effect[magic_school.effect_table] = i
+    dur_mult = numpy.array([ magic_school.dur_mult for magic_school in schools ])
+
+    ids, blobs, counts = [], [], []
+    for e in enchantments:
+        effects = e.get('ENAM', [])
+        if all(len(effect) == 24 for effect in effects):
+            ids.append(e['NAME'].lower())
+            blobs += effects
+            counts.append(len(effects))
+    effects = numpy.frombuffer(b''.join(blobs), numpy.dtype(effectFields))
+    owner = numpy.repeat(numpy.arange(len(ids)), counts)
+    school = school_of_effect[effects['id']]
+    known = school >= 0
+    effects, owner, school = effects[known], owner[known], school[known]
+
+    duration = effects['duration'].astype(numpy.int64)
+    duration[duration <= 1] = 40
+    mag = (effects['min'].astype(numpy.int64) + effects['max']) / 2 + dur_mult[school] * duration
+    mag = numpy.clip(mag, 0, 100)
+    magnitudes = numpy.zeros((len(ids), len(schools)))
+    numpy.maximum.at(magnitudes, (owner, school), mag)
+    return dict(zip(ids, magnitudes.tolist()))
+
+def scribeScrolls(scripted_magic_scrolls, magic_scrolls, rench, seed, profiler=noProfiler, use_numpy=True, shared_scripts=False):
+    '''yields the (section, packed record) of the scribe scrolls module, modifies the scrolls
+
+    The school costs are computed for all the enchantments at once with numpy
+    if it's installed, and one scroll at a time if not, with the same results.
+    With shared_scripts, scrolls with the same enchantment teach the same spell
+    with the same script, which gets its randomness from the enchantment id.
+    '''
+    for x in scripted_magic_scrolls:
+        x['TEXT'] += strangeMagicText
+        yield (SCROLLS, packRecord(x))
+
+    with profiler.phase('enchantments'):
+        #morrowind ids are case insensitive
+        enchantments = { e['NAME'].lower() : e for e in rench if 'DELE' not in e }
+        scroll_enchantments = [ (x, enchantments.get(x['ENAM'].lower())) for x in magic_scrolls ]
+
+    with profiler.phase('school costs'):
+        magnitudes = {}
+        if use_numpy and numpy is not None:
+            used = { e['NAME'].lower() : e for (_, e) in scroll_enchantments if e }
+            magnitudes = schoolMagnitudes(used.values())
+
+    #the script name and skill requirements text of each enchantment, if shared
+    learned = {}
+    for (x, enchantment) in scroll_enchantments:
         if not enchantment:
-            x['TEXT'] += '<FONT><DIV ALIGN="LEFT"><BR><BR>This scroll strange magic is impossible to learn<BR><BR></FONT>'
-            scrolls += [packRecord(x)]
+            x['TEXT'] += strangeMagicText
+            yield (SCROLLS, packRecord(x))
             continue
 
-        #black magic for getting attributes from a newly instanciated object because enums are singletons
-        schools = [e for e in Schools().__dict__.values()]
-        #for each school only count the highest difficulty enchantment component
-        for effect in enchantment['ENAM']:
-            for magic_school in schools:
-                effect_id = parseNum(effect[0:2])
-                if effect_id in magic_school.effect_table:
-                    magic_school.updatecost(parseNum(effect[12:16]), parseNum(effect[16:20]), parseNum(effect[20:]))
-                    break
-
-        script_name = 'lrn_' + x['NAME']
-        script_name = script_name[:32] #maybe truncate, if needed (32 bytes is the max size)
-        x['SCRI'] = script_name
-
-        x['TEXT'] += '<FONT><DIV ALIGN="LEFT"><BR><BR>Learning from this scroll requires these skills<BR><BR></FONT>'
-        for mag_school in schools:
-            color,cost,name = mag_school.color,mag_school.cost,mag_school.name
-            if cost > 0:
-                x['TEXT'] += '<FONT COLOR="{}"><DIV ALIGN="LEFT">{} {}<BR></FONT>'.format(color,cost,name)
-
-        spell_name = spellname_from_scroll(x['NAME'], x['FNAM'])
-        spell_record_name  = 'spl_' + x['NAME']
-        scripts += [packScript(script_name, createScript(script_name, spell_record_name, spell_name, schools))]
-        scrolls += [packRecord(x)]
-        spells  += [packSpell(enchantment, spell_record_name, spell_name, magic_scroll_cost(enchantment))]
-
-    def clearBit(int_type, offset):
-        mask = ~(1 << offset)
-        return(int_type & mask)
-    def testBit(int_type, offset):
-        mask = 1 << offset
-        return(int_type & mask)
+        if shared_scripts and enchantment['NAME'].lower() in learned:
+            (x['SCRI'], requirements_text) = learned[enchantment['NAME'].lower()]
+            x['TEXT'] += requirements_text
+            yield (SCROLLS, packRecord(x))
+            continue
 
+        #the scroll, or with shared_scripts the enchantment, names the script and spell
+        learn_id = enchantment['NAME'] if shared_scripts else x['NAME']
+        with profiler.phase('school costs'):
+            #black magic for getting attributes from a newly instanciated object because enums are singletons
+            schools = [e for e in Schools().__dict__.values()]
+            school_magnitudes = magnitudes.get(enchantment['NAME'].lower())
+            if school_magnitudes is not None:
+                for magic_school, magnitude in zip(schools, school_magnitudes):
+                    magic_school.magnitude = magnitude
+            else:
+                #for each school only count the highest difficulty enchantment component
+                for effect in enchantment.get('ENAM', []):
+                    for magic_school in schools:
+                        effect_id = parseNum(effect[0:2])
+                        if effect_id in magic_school.effect_table:
+                            magic_school.updatecost(parseNum(effect[12:16]), parseNum(effect[16:20]), parseNum(effect[20:]))
+                            break
+            #each scroll has its own randomness, so changing one doesn't change the others
+            rng = scrollRandom(seed, learn_id)
+            for magic_school in schools:
+                magic_school.randomizecost(rng)
+
+        with profiler.phase('scripts'):
+            script_name = 'lrn_' + learn_id
+            script_name = script_name[:32] #maybe truncate, if needed (32 bytes is the max size)
+            x['SCRI'] = script_name
+
+            requirements_text = '<FONT><DIV ALIGN="LEFT"><BR><BR>Learning from this scroll requires these skills<BR><BR></FONT>'
+            for mag_school in schools:
+                color,cost,name = mag_school.color,mag_school.cost,mag_school.name
+                if cost > 0:
+                    requirements_text += '<FONT COLOR="{}"><DIV ALIGN="LEFT">{} {}<BR></FONT>'.format(color,cost,name)
+            x['TEXT'] += requirements_text
+            if shared_scripts:
+                learned[enchantment['NAME'].lower()] = (script_name, requirements_text)
+
+            spell_name = spellname_from_scroll(x['NAME'], x['FNAM'])
+            spell_record_name  = 'spl_' + learn_id
+            script = packScript(script_name, createScript(script_name, spell_record_name, spell_name, schools))
+            scroll = packRecord(x)
+            spell = packSpell(enchantment, spell_record_name, spell_name, magicScrollCost(enchantment, rng))
+        yield (SCRIPTS, script)
+        yield (SCROLLS, scroll)
+        yield (SPELLS, spell)
+
+#AIDT service flags of spell sellers
+spellSellerFlag = 1 << 11
+#books, magic items, misc items and potions sellers, which can have scrolls in their inventory
+scrollSellerFlags = (1 << 3) | (1 << 10) | (1 << 12) | (1 << 13)
+
+def removeSpellSales(rnpcs, magic_scroll_ids):
+    '''npcs modified to not sell spells or items with a id in the magic_scroll_ids set (lowercase ids)'''
     npcs = []
-    vendors = []
-    magic_scroll_names = [ x['NAME'] for x in magic_scrolls ]
-    magic_scroll_names.append('random_scroll_all')
     for npc in rnpcs:
         if 'AIDT' not in npc or 'DELE' in npc:
             continue
 
         add = False
         flags = parseNum(npc['AIDT'][8:])
-        
-        #spell seller
-        if testBit(flags,11):
-            #print(npc['NAME'])
-            new_flag = clearBit(flags,11)
-            npc['AIDT']=npc['AIDT'][0:8]+packLong(new_flag,)
+
+        if flags & spellSellerFlag:
+            npc['AIDT'] = npc['AIDT'][0:8] + packLong(flags & ~spellSellerFlag)
             add = True
 
-        #magic_items, misc_item or book_items sellers or potions
-        can_sell_scrolls = testBit(flags, 10) or testBit(flags,12) or testBit(flags,3) or testBit(flags,13)
-        if can_sell_scrolls and 'NPCO' in npc:
+        #only decode the inventory of npcs that can sell scrolls
+        if flags & scrollSellerFlags and 'NPCO' in npc:
             items = npc['NPCO']
-            items_without_scrolls = [ item for item in items if parseString(item[4:]) not in magic_scroll_names ]
-            if len(items) > 0 and len(items) != len(items_without_scrolls):
-                npc['NPCO'] = tuple(items_without_scrolls)
+            items_without_scrolls = [ item for item in items if parseString(item[4:]).lower() not in magic_scroll_ids ]
+            if len(items) != len(items_without_scrolls):
+                npc['NPCO'] = items_without_scrolls
                 add = True
 
-        #still missing the items on the store cell, but we'll see
         if add:
-            npcs.append(packRecord(npc))
+            npcs.append(npc)
+    return npcs
+
+def scrollSellers(rnpcs):
+    '''lowercase ids of the npcs that can sell scrolls'''
+    return frozenset( npc['NAME'].lower() for npc in rnpcs
+                      if 'AIDT' in npc and 'DELE' not in npc and parseNum(npc['AIDT'][8:]) & scrollSellerFlags )
+
+def scrollContainers(rcont, magic_scroll_ids):
+    '''lowercase ids of the containers with a item with a id in magic_scroll_ids'''
+    return frozenset( cont['NAME'].lower() for cont in rcont if 'DELE' not in cont and 'CNTO' in cont and
+                      any( parseString(item[4:]).lower() in magic_scroll_ids for item in cont['CNTO'] ) )
+
+def trieRegex(ids):
+    '''regex that matches any of the (bytes) ids, nested by their common prefixes
+
+    A plain alternation tries every id in turn at each position, which is very
+    slow for a few hundred ids unless all of them share a prefix.
+    '''
+    heads = {}
+    for i in ids:
+        heads.setdefault(i[:1], []).append(i[1:])
+    optional = heads.pop(b'', None) is not None
+    alternatives = [ re.escape(head) + trieRegex(rest) for (head, rest) in sorted(heads.items()) ]
+    if not alternatives:
+        return b''
+    regex = alternatives[0] if len(alternatives) == 1 else b'(?:' + b'|'.join(alternatives) + b')'
+    return b'(?:' + regex + b')?' if optional else regex
+
+def containerReferences(buf, start, end, body, pattern):
+    '''(container id, owner id or None) lowercase pairs of the references pattern finds in a cell, without deleted ones
+
+    The cell is buf[start:end] and body its lowercased copy, where pattern finds the NAME
+    subrecords of the references. Only the subrecords after each found NAME are
+    read, until the FRMR (or MVRF) that starts the next reference.
+    '''
+    refs = []
+    for m in pattern.finditer(body):
+        if m.start() == 0: #the NAME of the cell itself
+            continue
+        owner = None
+        deleted = False
+        i = start + m.start()
+        i += 8 + int.from_bytes(buf[i+4:i+8], 'little')
+        while i + 8 <= end:
+            t = bytes(buf[i:i+4])
+            length = int.from_bytes(buf[i+4:i+8], 'little')
+            if t in (b'FRMR', b'MVRF'):
+                break
+            if t == b'ANAM':
+                owner = parseString(buf[i+8:i+8+length]).lower()
+            elif t == b'DELE':
+                deleted = True
+            i += 8 + length
+        if not deleted:
+            refs.append((m.group(1).decode('ascii', 'ignore'), owner))
+    return refs
+
+def containerPlacements(plugins, containers, stats=None, cache=None, digests=None):
+    '''{container id: [owner id or None of each placement]} of the (lowercase) containers in the cells of the plugins
+
+    plugins are (filename, cell offsets) pairs, like parsePlugin gives. Cells are only
+    searched, with a case insensitive regex for the NAME subrecords of the containers,
+    and only the references it finds are read. With a cache and the digests (content
+    hashes) of the plugins, the containers found in each plugin are cached, so
+    unchanged plugins aren't searched again while the containers are the same.
+    '''
+    if stats is None:
+        stats = ScanStats()
+    placements = { c : [] for c in containers }
+    if not containers:
+        return placements
+    containers_key = hashlib.sha1(b'\n'.join(sorted( c.encode('utf-8', 'surrogateescape') for c in containers ))).hexdigest()
+    pattern = None
+    for (filename, cells) in plugins:
+        if not cells:
+            continue
+        digest = digests.get(os.path.abspath(filename)) if cache and digests else None
+        found = cache.placements(filename, digest, containers_key) if digest else None
+        if found is not None:
+            stats.records_skipped += len(cells) // 2
+            stats.bytes_skipped += sum(cells[1::2]) - sum(cells[0::2]) + 8 * len(cells)
+        else:
+            if pattern is None:
+                #the bodies are lowercased before searching, ids are case insensitive (and the regex flag is much slower)
+                pattern = re.compile(b'name.\x00\x00\x00(' + trieRegex( c.encode('ascii', 'ignore') for c in containers ) + b')\x00', re.DOTALL)
+            found = {}
+            buf = mapFile(filename)
+            for i in range(0, len(cells), 2):
+                start, end = cells[i], cells[i+1]
+                refs = containerReferences(buf, start, end, bytes(buf[start:end]).lower(), pattern)
+                if refs:
+                    stats.records_parsed += 1
+                    stats.bytes_parsed += end - start + 16
+                else:
+                    stats.records_searched += 1
+                    stats.bytes_searched += end - start + 16
+                for (obj, owner) in refs:
+                    found.setdefault(obj, []).append(owner)
+            if digest:
+                cache.putPlacements(filename, digest, containers_key, found)
+        for (obj, owners) in found.items():
+            placements[obj] += owners
+    return placements
+
+def removeContainerScrolls(rcont, placements, sellers, magic_scroll_ids):
+    '''containers only placed in the world owned by scroll sellers, modified to not have items with a id in magic_scroll_ids
+
+    Merchants also sell what is in the containers they own in their cell. placements
+    are the owners of each placement of the containers, from containerPlacements.
+    The container record is changed, so a container that is also placed
+    somewhere not owned by a seller (like a dungeon) keeps its scrolls.
+    '''
+    containers = []
+    for cont in rcont:
+        if 'DELE' in cont or 'CNTO' not in cont:
+            continue
+        owners = placements.get(cont['NAME'].lower())
+        if not owners or not all( owner in sellers for owner in owners ):
+            continue
+        items = cont['CNTO']
+        items_without_scrolls = [ item for item in items if parseString(item[4:]).lower() not in magic_scroll_ids ]
+        if len(items) != len(items_without_scrolls):
+            cont['CNTO'] = items_without_scrolls
+            containers.append(cont)
+    return containers
+
+def fingerprint(filename, previous=None):
+    '''size, mtime and content hash of a file, the hash is reused from previous if size and mtime match'''
+    st = os.stat(filename)
+    fp = { 'path' : os.path.abspath(filename), 'size' : st.st_size, 'mtime' : st.st_mtime_ns }
+    if previous and all(previous.get(k) == v for k, v in fp.items()):
+        fp['hash'] = previous['hash']
+    else:
+        fp['hash'] = fileHash(filename)
+    return fp
+
+def contentKey(fp):
+    #the mtime only avoids hashing, a touched plugin is still the same plugin
+    return (fp.get('path'), fp.get('size'), fp.get('hash'))
+
+def sameInputs(manifest, old_manifest):
+    return manifest.get('version') == old_manifest.get('version') and manifest.get('seed') == old_manifest.get('seed') and \
+           manifest.get('shared_scripts', False) == old_manifest.get('shared_scripts', False) and \
+           [ contentKey(c) for c in manifest['content'] ] == [ contentKey(c) for c in old_manifest.get('content', []) ]
+
+def readManifest(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def writeManifest(filename, manifest):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, filename)
+
+def loadPlugin(filename, digest=None, cache=None, prefetcher=None):
+    '''(records, stats, cached) of a plugin, from the cache if possible
+
+    With a prefetcher, the plugin is parsed from the contents it read if it did.
+    digest is the content hash of the plugin if it's known, so it isn't hashed again.
+    '''
+    start = time.perf_counter()
+    stats = ScanStats()
+    #always taken, even if it's cached, so it doesn't count against the prefetch budget
+    data = prefetcher.get(filename) if prefetcher else None
+    records = cache.get(filename, digest) if cache else None
+    cached = records is not None
+    if not cached:
+        index = cache.index(filename) if cache else None
+        records = parsePlugin(filename if data is None else data, stats, index)
+        if cache:
+            cache.put(filename, records, digest)
+            if index is None and os.path.getsize(filename) >= indexMinSize:
+                cache.putIndex(filename, RecordIndex.build(filename))
+    stats.seconds = time.perf_counter() - start
+    return (records, stats, cached)
+
+class Prefetcher:
+    '''reads plugins in a background thread, while the main thread parses the ones before them
+
+    At most budget bytes of read but not yet taken plugins are kept, a plugin bigger
+    than the budget is read when no other is waiting. The plugins for which skip
+    is true (like the cached ones) aren't read. Also measures how much of the
+    reading happened while the main thread was doing something else.
+    '''
+    def __init__(self, filenames, budget, skip=None):
+        self.budget = budget
+        self.pending = {}
+        self.pending_bytes = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.files_read = 0
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.thread = threading.Thread(target=self._run, args=(list(filenames), skip), daemon=True)
+        self.thread.start()
+
+    def _run(self, filenames, skip):
+        for f in filenames:
+            data = None
+            try:
+                if not (skip and skip(f)):
+                    size = os.path.getsize(f)
+                    with self.cond:
+                        self.cond.wait_for(lambda: self.stopped or self.pending_bytes == 0 or self.pending_bytes + size <= self.budget)
+                    if self.stopped:
+                        return
+                    start = time.perf_counter()
+                    with open(f, 'rb') as fh:
+                        data = fh.read()
+                    self.read_seconds += time.perf_counter() - start
+                    self.files_read += 1
+                    self.bytes_read += len(data)
+            except Exception: #the main thread reads it instead
+                data = None
+            with self.cond:
+                self.pending[f] = data
+                self.pending_bytes += len(data) if data else 0
+                self.cond.notify_all()
+
+    def get(self, filename):
+        '''the contents of the plugin, None if it wasn't read'''
+        start = time.perf_counter()
+        with self.cond:
+            self.cond.wait_for(lambda: filename in self.pending)
+            data = self.pending.pop(filename)
+            self.pending_bytes -= len(data) if data else 0
+            self.cond.notify_all()
+        self.wait_seconds += time.perf_counter() - start
+        return data
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def __str__(self):
+        overlapped = 1.0 if self.read_seconds == 0 else max(0.0, self.read_seconds - self.wait_seconds) / self.read_seconds
+        return '{} plugins ({:.1f} MiB) read ahead in {:.3f} seconds, parsing waited {:.3f} seconds for them, {:.0%} of the reading overlapped'.format(
+            self.files_read, self.bytes_read / (1024 * 1024), self.read_seconds, self.wait_seconds, overlapped)
+
+class RecordStore:
+    '''parsed records of the plugins of one or more load orders, each plugin is parsed once
+
+    Plugins are keyed by their absolute path and parsed again only if their size or mtime change.
+    The records of a load order are given out as copies, so the transforms
+    can change them without changing the records another load order sees.
+    With a prefetch budget (in bytes) and one job, the plugins are read ahead
+    in a thread while the ones before them are parsed, prefetcher is the last one.
+    '''
+    def __init__(self, jobs=1, profiler=noProfiler, prefetch=0):
+        self.jobs = jobs
+        self.profiler = profiler
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.plugins = {}
+
+    def _stat(self, filename):
+        st = os.stat(filename)
+        return (st.st_size, st.st_mtime_ns)
+
+    def load(self, plugins, cache=None, digests=None):
+        '''parses the plugins not in the store, (stats, cache hits, plugins already in the store)
+
+        digests are the known content hashes of the plugins, by absolute path.
+        '''
+        plugins = list(OrderedDict.fromkeys(os.path.abspath(f) for f in plugins))
+        stat = { f : self._stat(f) for f in plugins }
+        missing = [ f for f in plugins if f not in self.plugins or self.plugins[f][0] != stat[f] ]
+        missing_digests = [ (digests or {}).get(f) for f in missing ]
+        executor = None
+        self.prefetcher = None
+        if (self.jobs == 1 or len(missing) < 2) and self.prefetch and missing:
+            self.prefetcher = Prefetcher(missing, self.prefetch, cache.fresh if cache else None)
+            loaded = map(functools.partial(loadPlugin, cache=cache, prefetcher=self.prefetcher), missing, missing_digests)
+        elif self.jobs == 1 or len(missing) < 2:
+            loaded = map(functools.partial(loadPlugin, cache=cache), missing, missing_digests)
+        else:
+            #each plugin is parsed independently, map returns them in load order
+            executor = ProcessPoolExecutor(self.jobs)
+            loaded = executor.map(functools.partial(loadPlugin, cache=cache), missing, missing_digests)
+        stats = ScanStats()
+        hits = 0
+        #a plugin that fails to load doesn't stop --watch, so the threads and processes can't be left behind
+        try:
+            for f, (records, plugin_stats, cached) in zip(missing, loaded):
+                self.plugins[f] = (stat[f], records)
+                stats.add(plugin_stats)
+                hits += cached
+                self.profiler.plugin(f, plugin_stats, cached)
+        finally:
+            if executor:
+                executor.shutdown()
+            if self.prefetcher:
+                self.prefetcher.close()
+        return (stats, hits, len(plugins) - len(missing))
+
+    def forget(self, plugins):
+        '''forgets the plugins, so they are parsed again'''
+        for f in plugins:
+            self.plugins.pop(os.path.abspath(f), None)
+
+    def prune(self, keep):
+        '''forgets the plugins not in keep, absolute paths of the plugins still used'''
+        for f in set(self.plugins) - set(keep):
+            del self.plugins[f]
+
+    def records(self, plugins):
+        '''(books, enchantments, npcs, containers, cells) of a loaded load order
+
+        Unlike a levelled list merge, only the 'latest' version of a record is kept.
+        cells are (plugin, cell offsets) pairs, for containerPlacements.
+        '''
+        rbook, rench, rnpcs, rcont, cells = [], [], [], [], []
+        for f in plugins:
+            (rbookt, encht, npct, contt, cellst) = self.plugins[os.path.abspath(f)][1]
+            rbook += rbookt
+            rench += encht
+            rnpcs += npct
+            rcont += contt
+            cells.append((f, cellst))
+        return tuple([ rec.copy() for rec in latestRecords(records) ] for records in (rbook, rench, rnpcs, rcont)) + (cells,)
+
+mod1Name = 'scribe_scrolls.omwaddon'
+mod2Name = 'no_spells_for_sale.omwaddon'
+author  = "i30817, copyright 2018"
+
+def loadOrder(cfg):
+    '''the plugins of the cfg, in load order, without the modules this script creates'''
+    return [ f for f in readCfg(cfg) if os.path.basename(f) not in (mod1Name, mod2Name) ]
+
+def writeScribeScrolls(filename, rbook, rench, seed, profiler=noProfiler, use_numpy=True, shared_scripts=False):
+    '''creates the scribe scrolls module, returns the magic scrolls'''
+    #we don't want to modify magic scrolls already with a script... 
+    #except for their text to indicate it can't be learned in-game because of 'strange magic'
+    scripted_magic_scrolls, magic_scrolls = splitMagicScrolls(rbook)
 
-    author  = "i30817, copyright 2018"
     moddesc = "scribe scrolls: scrolls from all mods (at the time of creation) can be learned. Scrolls with a magicka cost above 200 will have their cost randomized between 180-200. Requires to be near the end of the load order."
+    #records are written as they are created, in three sections: scripts, spells and scrolls
+    counts, sizes = [0, 0, 0], [0, 0, 0]
+    with ModWriter(filename, author, moddesc, 3) as writer:
+        for (section, record) in scribeScrolls(scripted_magic_scrolls, magic_scrolls, rench, seed, profiler, use_numpy, shared_scripts):
+            with profiler.phase('write'):
+                writer.write(record, section)
+            counts[section] += 1
+            sizes[section] += len(record)
+
+    if shared_scripts and counts[SCRIPTS]:
+        #without sharing, each learnable scroll would have its own script and spell of about the same size
+        learnable = sum( 'SCRI' in x for x in magic_scrolls )
+        saved = learnable - counts[SCRIPTS]
+        saved_bytes = saved * (sizes[SCRIPTS] + sizes[SPELLS]) / counts[SCRIPTS]
+        print("Shared scripts: {} learnable scrolls use {} scripts and spells, {} fewer records and about {:.1f} KiB smaller".format(
+            learnable, counts[SCRIPTS], 2 * saved, saved_bytes / 1024))
+    return magic_scrolls
+
+def writeNoSpellsForSale(filename, rnpcs, rcont, cells, magic_scrolls, profiler=noProfiler, cache=None, digests=None):
+    '''creates the no spells for sale module, the cells searched for containers are cached in cache if given'''
+    magic_scroll_ids = frozenset(x['NAME'].lower() for x in magic_scrolls) | {'random_scroll_all'}
+    moddesc = "no spells for sale: prevents all npcs from all mods (at the time of creation) from selling spells or spell scrolls in their inventory or in the containers only they own."
+    with profiler.phase('npcs'):
+        npcs = removeSpellSales(rnpcs, magic_scroll_ids)
+    with profiler.phase('containers'):
+        cell_stats = ScanStats()
+        placements = containerPlacements(cells, scrollContainers(rcont, magic_scroll_ids), cell_stats, cache, digests)
+        containers = removeContainerScrolls(rcont, placements, scrollSellers(rnpcs), magic_scroll_ids)
+    print("Cells searched for containers with scrolls: {}".format(cell_stats))
+    with profiler.phase('write'), ModWriter(filename, author, moddesc) as writer:
+        for npc in npcs:
+            writer.write(packRecord(npc))
+        for container in containers:
+            writer.write(packRecord(container))
+
+def verifyIndexes(plugins, cache):
+    '''checks the saved record indexes of the plugins against the plugins, the stale ones are built again
+
+    Returns the absolute paths of the plugins with a stale index, which changed without changing their size or mtime.
+    '''
+    if cache is None:
+        print("Record indexes are kept in the plugin cache, there are none to verify without it.")
+        return []
+    stale = [ os.path.abspath(f) for f in plugins if not cache.verifyIndex(f) ]
+    print("Record indexes verified, {} stale ones built again{}".format(len(stale), ': ' + ', '.join(os.path.basename(f) for f in stale) if stale else ''))
+    return stale
+
+def createModules(cfg, outmoddir, store, cache=None, force=False, seed=None, profiler=noProfiler, use_numpy=True, shared_scripts=False, verify_index=False):
+    '''creates the modules of the load order of cfg in outmoddir, with the plugins parsed by store
+
+    Returns False if nothing was done because the load order didn't change.
+    '''
+    with profiler.phase('config'):
+        plugins = loadOrder(cfg)
+    stale = verifyIndexes(plugins, cache) if verify_index else []
+    #their size and mtime didn't change, so neither the store nor the manifest would notice
+    store.forget(stale)
+
+    mod1 = os.path.join(outmoddir, mod1Name)
+    mod2 = os.path.join(outmoddir, mod2Name)
+
+    #nothing to do if the load order and plugins are the same as when the modules were created
+    manifest_file = os.path.join(outmoddir, manifestName)
+    with profiler.phase('manifest'):
+        old_manifest = readManifest(manifest_file)
+        old_content = { c['path'] : c for c in old_manifest.get('content', []) }
+        if seed is None: #keep the costs of the last time, or start with a random seed
+            seed = old_manifest.get('seed', random.SystemRandom().getrandbits(32))
+        manifest = { 'version' : scriptVersion, 'seed' : seed, 'shared_scripts' : shared_scripts,
+                     'content' : [ fingerprint(f, None if os.path.abspath(f) in stale else old_content.get(os.path.abspath(f))) for f in plugins ] }
+    if not force and sameInputs(manifest, old_manifest) and os.path.exists(mod1) and os.path.exists(mod2):
+        writeManifest(manifest_file, manifest) #touched plugins don't need to be hashed again next time
+        print("Load order unchanged since '{}' and '{}' were created, nothing to do (use --force to create them again).".format(mod1Name, mod2Name))
+        return False
+    if old_manifest and not sameInputs(manifest, old_manifest):
+        changed = [ c for c in manifest['content'] if contentKey(c) != contentKey(old_content.get(c['path'], {})) ]
+        removed = set(old_content) - set(c['path'] for c in manifest['content'])
+        if changed or removed:
+            print("Load order changed: {} plugins added or modified, {} removed".format(len(changed), len(removed)))
+        else:
+            print("Seed, script version or script sharing changed since the modules were created...")
+
+    #the plugins were just hashed for the manifest, the cache doesn't need to hash them again
+    digests = { c['path'] : c['hash'] for c in manifest['content'] }
+    with profiler.phase('scan'):
+        (stats, hits, shared) = store.load(plugins, cache, digests)
+    if cache:
+        print("Plugin cache: {} of {} plugins were already parsed".format(hits, len(plugins) - shared))
+    if shared:
+        print("Plugins already parsed in this run: {}".format(shared))
+    print("Plugins scanned: {}".format(stats))
+    if store.prefetcher and store.prefetcher.files_read:
+        print("Prefetch: {}".format(store.prefetcher))
+
+    with profiler.phase('dedup'):
+        (rbook, rench, rnpcs, rcont, cells) = store.records(plugins)
+
     if not os.path.exists(outmoddir):
         p = Path(outmoddir)
         p.mkdir(parents=True)
 
-    with open(mod1, 'wb') as f:
-        f.write(packTES3(author, moddesc, len(scripts)+len(scrolls)+len(spells)))
-        for script in scripts:
-            f.write(script)
-        for spell in spells:
-            f.write(spell)
-        for scroll in scrolls:
-            f.write(scroll)
-
-    moddesc = "no spells for sale: prevents all npcs from all mods (at the time of creation) from selling spells or spell scrolls in their inventory - due to a engine pecularity they will still sell scrolls if at their localization (on containers or in the world)."
-    with open(mod2, 'wb') as f:
-        f.write(packTES3(author, moddesc, len(npcs)))
-        for npc in npcs:
-            f.write(npc)
-    
+    magic_scrolls = writeScribeScrolls(mod1, rbook, rench, seed, profiler, use_numpy, shared_scripts)
+    writeNoSpellsForSale(mod2, rnpcs, rcont, cells, magic_scrolls, profiler, cache, digests)
+    writeManifest(manifest_file, manifest)
+    return True
+
+def pluginCache(outmoddir, use_cache=True, clear_cache=False, cache_size=defaultCacheSize):
+    '''the plugin cache of outmoddir, None if not used'''
+    if not use_cache and not clear_cache:
+        return None
+    cache = PluginCache(os.path.join(outmoddir, cacheDirName), cache_size)
+    if clear_cache:
+        cache.clear()
+        print("Plugin cache cleared...")
+    return cache if use_cache else None
+
+def main(cfg, outmoddir, use_cache=True, clear_cache=False, cache_size=defaultCacheSize, jobs=1, force=False, seed=None, profile=False, use_numpy=True, shared_scripts=False):
+    mainBatch([(cfg, outmoddir)], use_cache, clear_cache, cache_size, jobs, force, seed, profile, use_numpy, shared_scripts=shared_scripts)
+
+def mainBatch(profiles, use_cache=True, clear_cache=False, cache_size=defaultCacheSize, jobs=1, force=False, seed=None, profile=False, use_numpy=True, watch_interval=None, shared_scripts=False, verify_index=False, prefetch=0):
+    '''creates the modules of each (cfg, outmoddir) profile, the plugins they share are parsed once
+
+    With a watch_interval, keeps running and creates them again when the plugins or configs change.
+    prefetch is the memory budget in bytes of the plugins read ahead, 0 to read them as they are parsed.
+    '''
+    profiler = Profiler(profile)
+    store = RecordStore(jobs, profiler, prefetch)
+    caches = [ pluginCache(outmoddir, use_cache, clear_cache, cache_size) for (_, outmoddir) in profiles ]
+
+    def createAll(force, verify_index):
+        created = False
+        for (cfg, outmoddir), cache in zip(profiles, caches):
+            if len(profiles) > 1:
+                print("\nProfile '{}' into '{}'".format(cfg, outmoddir))
+            created |= createModules(cfg, outmoddir, store, cache, force, seed, profiler, use_numpy, shared_scripts, verify_index)
+        return created
+
+    created = createAll(force, verify_index)
+    profiler.report()
+    if created:
+        printInstructions()
+    if watch_interval:
+        watch(profiles, store, lambda: createAll(False, False), watch_interval)
+
+#seconds the watched files have to stay the same before the modules are created again
+watchDebounce = 2.0
+
+def watchedFiles(profiles):
+    '''absolute paths of the configs, data dirs and content files of the profiles'''
+    files = set()
+    for (cfg, _) in profiles:
+        (data_dirs, mods, configs) = cfgSettings(cfg)
+        index = dataIndex(data_dirs)
+        files.update(configs, data_dirs, ( index[m.lower()] for m in mods if m.lower() in index ))
+    return set(os.path.abspath(f) for f in files)
+
+def fileStats(files):
+    '''(size, mtime) of each file, None if it doesn't exist'''
+    stats = {}
+    for f in files:
+        try:
+            st = os.stat(f)
+            stats[f] = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            stats[f] = None
+    return stats
+
+def watch(profiles, store, create, interval=1.0, debounce=watchDebounce):
+    '''calls create when the configs, data dirs or content files of the profiles change, until interrupted
+
+    The files are polled every interval seconds. After a change, create waits until they
+    stay the same for debounce seconds, so installing a mod that copies many files
+    creates the modules once. The store keeps the plugins that didn't change parsed.
+    '''
+    files = watchedFiles(profiles)
+    last = fileStats(files)
+    print("Watching {} files for changes, press ctrl-c to stop...".format(len(files)))
+    try:
+        while True:
+            time.sleep(interval)
+            current = fileStats(files)
+            if current == last:
+                continue
+            #wait for the files to stop changing
+            while True:
+                time.sleep(debounce)
+                settled = fileStats(files)
+                if settled == current:
+                    break
+                current = settled
+            start = time.perf_counter()
+            try:
+                create()
+                print("Modules checked in {:.3f} seconds".format(time.perf_counter() - start))
+            except Exception as e: #a half copied plugin shouldn't stop the watch, the next change tries again
+                print("Couldn't create the modules: {!r}".format(e))
+            #the load order may have changed, and the modules we wrote shouldn't count as a change
+            files = watchedFiles(profiles)
+            store.prune(files)
+            last = fileStats(files)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+def printInstructions():
     print("\n\n****************************************")
     print(" When you next start the OpenMW Launcher, look for 2 modules named '{}' and '{}'.".format(mod1Name,mod2Name))
     print(" Drag them to the bottom of the load list and enable one or both them.\n They need to load after all modules that add scrolls or npcs.\n Can be at the very last or just before the omwllf plugin.")
@@ -449,19 +1782,71 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-c', '--conffile', type = str, default = None,
-                        action = 'store', required = False,
-                        help = 'Conf file to use. Optional. By default, attempts to use the default conf file location.')
+                        action = 'append', required = False,
+                        help = 'Conf file to use. Optional. By default, attempts to use the default conf file location. Repeat it, with a -d for each, to create the modules of several profiles at once, parsing the plugins they share only once.')
 
     parser.add_argument('-d', '--moddir', type = str, default = None,
-                        action = 'store', required = False,
+                        action = 'append', required = False,
                         help = 'Directory to store the new module in. By default, attempts to use the default work directory for OpenMW-CS')
+
+    parser.add_argument('--no-cache', dest = 'use_cache', default = True,
+                        action = 'store_false', required = False,
+                        help = 'Parse every plugin again, without reading or updating the plugin cache in the mod directory.')
+
+    parser.add_argument('--clear-cache', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Remove all cached plugins before running.')
+
+    parser.add_argument('--cache-size', type = int, default = defaultCacheSize // (1024 * 1024),
+                        action = 'store', required = False,
+                        help = 'Maximum size of the plugin cache in MiB, least recently used plugins are removed first. Default %(default)s.')
+
+    parser.add_argument('-j', '--jobs', type = int, default = 1,
+                        action = 'store', required = False,
+                        help = 'Number of processes parsing plugins at the same time, 0 for one per cpu. Default %(default)s.')
+
+    parser.add_argument('-f', '--force', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Create the modules even if the load order and plugins did not change since the last time.')
+
+    parser.add_argument('-s', '--seed', type = int, default = None,
+                        action = 'store', required = False,
+                        help = 'Seed of the random skill requirements and spell costs. The same seed and plugins create the same modules. By default, the seed of the last time is reused.')
+
+    parser.add_argument('--no-numpy', dest = 'use_numpy', default = True,
+                        action = 'store_false', required = False,
+                        help = 'Compute the school costs one scroll at a time even if numpy is installed. The modules are the same.')
+
+    parser.add_argument('--shared-scripts', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Scrolls with the same enchantment teach the same spell with the same script, so the module has fewer scripts for OpenMW to compile. Their skill requirements are the same too.')
+
+    parser.add_argument('--verify-index', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Check the record indexes of the big plugins in the cache against the plugins, and build the stale ones again.')
+
+    parser.add_argument('--prefetch', type = int, default = 0,
+                        action = 'store', required = False,
+                        help = 'Read the next plugins in the background while parsing, keeping at most this many MiB read ahead. Helps on slow disks, only with one job. Default %(default)s, off.')
+
+    parser.add_argument('--watch', type = float, default = None, nargs = '?', const = 1.0,
+                        action = 'store', required = False,
+                        help = 'Keep running and create the modules again when the conf file or the plugins change, checking every this many seconds (default 1). Only the changed plugins are parsed again.')
+
+    parser.add_argument('--profile', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Print the time and peak memory of each phase, and the time and bytes read of each plugin.')
+
+    parser.add_argument('--profile-dump', type = str, default = None,
+                        action = 'store', required = False,
+                        help = 'Run under cProfile and write the stats to this file, to read with the pstats module. Only profiles the main process.')
     p = parser.parse_args()
 
 
     # determine the conf file to use
     confFile = ''
     if p.conffile:
-        confFile = p.conffile
+        confFile = p.conffile[0]
     else:
         pl = sys.platform
         if pl in configPaths:
@@ -495,7 +1880,7 @@ if __name__ == '__main__':
 
     baseModDir = ''
     if p.moddir:
-        baseModDir = p.moddir
+        baseModDir = p.moddir[0]
     else:
         pl = sys.platform
         if pl in configPaths:
@@ -518,11 +1903,27 @@ if __name__ == '__main__':
             sys.exit(1)
 
 
-    if not os.path.exists(confFile):
-        print("Sorry, the conf file '%s' doesn't seem to exist." % confFile)
-        sys.exit(1)
+    profiles = [(confFile, baseModDir)]
+    if p.conffile and len(p.conffile) > 1:
+        if not p.moddir or len(p.moddir) != len(p.conffile):
+            print("Sorry, each conf file needs its own mod directory, use a -d for each -c.")
+            sys.exit(1)
+        profiles = list(zip(p.conffile, p.moddir))
+        if len(set(os.path.abspath(d) for d in p.moddir)) != len(p.moddir):
+            print("Sorry, the mod directories of the profiles have to be different.")
+            sys.exit(1)
 
-    main(confFile, baseModDir)
+    for (confFile, _) in profiles:
+        if not os.path.exists(confFile):
+            print("Sorry, the conf file '%s' doesn't seem to exist." % confFile)
+            sys.exit(1)
+
+    args = (profiles, p.use_cache, p.clear_cache, p.cache_size * 1024 * 1024, p.jobs or os.cpu_count(), p.force, p.seed, p.profile, p.use_numpy, p.watch, p.shared_scripts, p.verify_index, p.prefetch * 1024 * 1024)
+    if p.profile_dump:
+        import cProfile
+        cProfile.run('mainBatch(*args)', p.profile_dump)
+    else:
+        mainBatch(*args)
 
 
 